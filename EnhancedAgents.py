@@ -1,10 +1,1977 @@
-from autogen import AssistantAgent, UserProxyAgent, Agent
+from autogen import AssistantAgent, ConversableAgent, UserProxyAgent, Agent
 from typing import Any, Callable, Dict, List, Optional, Tuple, Type, Union
+from collections import Counter, OrderedDict, defaultdict, deque, namedtuple
+from collections.abc import Sequence
+import asyncio
+import atexit
+import contextlib
+import contextvars
+import functools
+import hashlib
+import inspect
+import json
+import math
 import os
+import re
+import sqlite3
+import threading
+import time
+import weakref
+
+import numpy as np
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 # Default directory for storing agent memories
 MEMORY_DIRECTORY = "Managed_Memories"
 
+# Debug output levels for MemoryInstrumentation.verbosity: one line summaries, then full payloads (chat contents, trimmed messages, MMA chats)
+DEBUG_SUMMARY = 1
+DEBUG_PAYLOADS = 2
+
+
+# Instrumentation hooks for MEAs - timing spans around receive, trim, summarize, stm_to_ltm, lookup and llm_call, and counters for
+# llm_calls, prompt_tokens, completion_tokens, bytes_read, bytes_written, store_transactions and memory_job_errors.
+# The default does nothing: spans are a shared null context and counts are dropped. Subclass and override span/count to export
+# to a tracing or metrics system, or use RecordingInstrumentation. Set enabled on subclasses that record anything - work done only
+# to feed the hooks (token and byte counts) is skipped otherwise.
+class MemoryInstrumentation:
+    
+    enabled = False
+    
+    def __init__(self, verbosity = 0):
+        self.verbosity = verbosity
+    
+    # Context manager around one timed operation
+    def span(self, name, **attributes):
+        return NULL_SPAN
+    
+    def count(self, name, value = 1, **attributes):
+        pass
+    
+    # Print a debug message at or below the verbosity level. Pass a callable to only build the message when it is shown.
+    def debug(self, level, message):
+        if level <= self.verbosity:
+            print(f"DEBUG: {message() if callable(message) else message}")
+
+
+NULL_SPAN = contextlib.nullcontext()
+NULL_INSTRUMENTATION = MemoryInstrumentation()
+
+
+# Instrumentation that keeps totals in memory - span count, total and max time, and counter sums. Read them with snapshot().
+class RecordingInstrumentation(MemoryInstrumentation):
+    
+    enabled = True
+    
+    def __init__(self, verbosity = 0):
+        super().__init__(verbosity)
+        self.lock = threading.Lock()
+        # name -> [count, total seconds, max seconds]
+        self.spans = {}
+        self.counters = Counter()
+    
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                stats = self.spans.setdefault(name, [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+    
+    def count(self, name, value = 1, **attributes):
+        with self.lock:
+            self.counters[name] += value
+    
+    def snapshot(self):
+        with self.lock:
+            return {
+                "spans": {name: {"count": n, "total_ms": total*1000, "mean_ms": total*1000/n, "max_ms": longest*1000} for name, (n, total, longest) in self.spans.items()},
+                "counters": dict(self.counters),
+            }
+    
+    def reset(self):
+        with self.lock:
+            self.spans.clear()
+            self.counters.clear()
+
+
+# Swap an agents AutoGen LLM reply for instrumented_oai_reply, so every LLM call it makes is timed and counted. An async twin goes in
+# front of it for a_generate_reply (generate_reply skips coroutine functions), so async conversations don't block the event loop.
+def instrument_oai_replies(agent):
+    for position, reply in enumerate(agent._reply_func_list):
+        if reply["reply_func"] is ConversableAgent.generate_oai_reply:
+            reply["reply_func"] = instrumented_oai_reply
+            agent.register_reply(reply["trigger"], a_instrumented_oai_reply, position = position)
+            break
+
+
+def instrumented_oai_reply(agent, messages = None, sender = None, config = None):
+    instrumentation = agent.instrumentation
+    if not instrumentation.enabled:
+        return ConversableAgent.generate_oai_reply(agent, messages, sender, config)
+    
+    with instrumentation.span("llm_call", agent = agent.name):
+        final, reply = ConversableAgent.generate_oai_reply(agent, messages, sender, config)
+    if final:
+        model = agent.llm_config.get("model", "gpt-3.5-turbo")
+        prompt = agent._oai_system_message + (agent._oai_messages[sender] if messages is None else messages)
+        instrumentation.count("llm_calls", agent = agent.name)
+        instrumentation.count("prompt_tokens", sum(count_message_tokens(m, model) for m in prompt), agent = agent.name)
+        instrumentation.count("completion_tokens", count_message_tokens(reply if isinstance(reply, dict) else {"content": reply}, model), agent = agent.name)
+    return final, reply
+
+
+# The LLM call runs in a thread, with the callers context (current sender, memory partition)
+async def a_instrumented_oai_reply(agent, messages = None, sender = None, config = None):
+    return await asyncio.to_thread(instrumented_oai_reply, agent, messages, sender, config)
+
+
+# AutoGen runs function calls inline, on the event loop for a_generate_reply. Put an async twin of the function call reply in front
+# of it on agent, so its async path runs them in a thread - a MEA function like lookup_from_long_term_memory makes its own LLM call.
+def thread_function_calls(agent):
+    reply_funcs = [reply["reply_func"] for reply in agent._reply_func_list]
+    if a_threaded_function_call_reply in reply_funcs or ConversableAgent.generate_function_call_reply not in reply_funcs:
+        return
+    position = reply_funcs.index(ConversableAgent.generate_function_call_reply)
+    agent.register_reply(agent._reply_func_list[position]["trigger"], a_threaded_function_call_reply, position = position)
+
+
+async def a_threaded_function_call_reply(agent, messages = None, sender = None, config = None):
+    return await asyncio.to_thread(ConversableAgent.generate_function_call_reply, agent, messages, sender, config)
+
+
+# One stored memory. tier is 'stm', 'ltm', 'consolidating' (left STM, not yet in LTM) or 'archive' (left the hot LTM). shard is the LTM shard, None otherwise.
+MemoryRecord = namedtuple("MemoryRecord", ["id", "tier", "shard", "content", "source", "created"])
+
+
+# Storage backend interface for agent memories. Memories keep their id through tier moves, so ids also give age order.
+class MemoryStore:
+    
+    # Add memories to the end of a tier. Returns their ids.
+    def append(self, tier, memories, source, shard = None):
+        raise NotImplementedError
+    
+    # MemoryRecords of a tier (optionally one LTM shard), oldest first
+    def read(self, tier, shard = None):
+        raise NotImplementedError
+    
+    # Number of memories in a tier
+    def count(self, tier):
+        raise NotImplementedError
+    
+    # MemoryRecords of a tier with the given source, oldest first. Scans the tier - stores should override this with an index.
+    def find(self, tier, source):
+        return [record for record in self.read(tier) if record.source == source]
+    
+    # Ids of up to limit of the oldest memories of a tier
+    def oldest_ids(self, tier, limit):
+        return [record.id for record in self.read(tier)[:limit]]
+    
+    # Replace every memory of a tier (optionally one LTM shard) in one transaction. Returns the new ids.
+    def replace(self, tier, memories, source, shard = None):
+        raise NotImplementedError
+    
+    # Move memories to another tier in one transaction
+    def move(self, ids, tier, shard = None):
+        raise NotImplementedError
+    
+    def delete(self, ids):
+        raise NotImplementedError
+    
+    # Context manager - changes made inside it are applied together or not at all. Stores that can't group changes apply them one by one.
+    def atomic(self):
+        return contextlib.nullcontext()
+    
+    # Logged changes after seq as (seq, operation, detail), oldest first. Stores without an operation log have none.
+    def operations(self, since_seq = 0):
+        return []
+    
+    # Up to limit MemoryRecords of a tier sharing words with query, best match first. Scans the tier - stores should override this with an index.
+    def search(self, tier, query, limit = 10):
+        terms = set(tokenize_memory(query))
+        if not terms:
+            return []
+        scored = [(len(terms.intersection(tokenize_memory(record.content))), record) for record in self.read(tier)]
+        scored = [(score, record) for score, record in scored if score]
+        scored.sort(key = lambda item: (-item[0], -item[1].id))
+        return [record for score, record in scored[:limit]]
+    
+    def close(self):
+        pass
+
+
+# Default memory store - one SQLite database per agent. Every change is a transaction, so a crash leaves either the old or the new
+# memories, never a half written file, and memory text can contain any character (including '|'). The database is memory-mapped
+# up to mmap_bytes, and the archive tier has a full text index (if SQLite was built with FTS5) so it can be searched without reading it.
+# Every change is also recorded, in the same transaction, in an append-only operation log with sequence numbers. The memories
+# table is the snapshot the log leads up to - once the log holds compact_every operations it is compacted into it, and the
+# sequence number of the snapshot is kept as meta 'snapshot_seq'.
+class SQLiteMemoryStore(MemoryStore):
+    
+    # Tiers kept in the full text index
+    SEARCHABLE_TIERS = ("archive",)
+    
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS memories (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tier TEXT NOT NULL,
+        shard INTEGER,
+        content TEXT NOT NULL,
+        source TEXT NOT NULL,
+        created REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS memories_by_tier ON memories (tier, shard, id);
+    CREATE INDEX IF NOT EXISTS memories_by_source ON memories (tier, source, id);
+    CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    CREATE TABLE IF NOT EXISTS operation_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        operation TEXT NOT NULL,
+        detail TEXT NOT NULL,
+        created REAL NOT NULL
+    );
+    """
+    
+    def __init__(self, path, instrumentation = NULL_INSTRUMENTATION, mmap_bytes = 1 << 26, compact_every = 1000):
+        self.path = path
+        self.lock = threading.RLock()
+        self.instrumentation = instrumentation
+        self.compact_every = compact_every
+        
+        # Cursor of the transaction in progress - transactions started inside it join it
+        self.cursor = None
+        
+        # Shared between the reply path and the consolidation worker, access is serialized by the lock
+        self.connection = sqlite3.connect(path, check_same_thread = False, isolation_level = None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(f"PRAGMA mmap_size={int(mmap_bytes)}")
+        self.connection.executescript(self.SCHEMA)
+        
+        # Memory words (tokenize_memory) by memory id, for searchable tiers. Without FTS5, search falls back to scanning the tier.
+        try:
+            self.connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS memory_search USING fts5(terms)")
+            self.full_text_search = True
+        except sqlite3.OperationalError:
+            self.full_text_search = False
+        
+        # Tier counts are kept in memory so count() never scans - the store is the only writer to its database
+        self.counts = Counter(dict(self.connection.execute("SELECT tier, COUNT(*) FROM memories GROUP BY tier")))
+        self.logged_operations = self.connection.execute("SELECT COUNT(*) FROM operation_log").fetchone()[0]
+    
+    # Run func(cursor) inside a transaction, rolling back on any error
+    def transaction(self, func):
+        with self.atomic():
+            return func(self.cursor)
+    
+    # One transaction around everything done inside, including other transactions - they join it instead of committing on their own
+    @contextlib.contextmanager
+    def atomic(self):
+        with self.lock:
+            if self.cursor is not None:
+                yield
+                return
+            
+            self.instrumentation.count("store_transactions")
+            self.cursor = self.connection.cursor()
+            self.cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.cursor.execute("ROLLBACK")
+                self.counts = Counter(dict(self.connection.execute("SELECT tier, COUNT(*) FROM memories GROUP BY tier")))
+                self.logged_operations = self.connection.execute("SELECT COUNT(*) FROM operation_log").fetchone()[0]
+                raise
+            else:
+                self.cursor.execute("COMMIT")
+            finally:
+                self.cursor = None
+            
+            if self.compact_every and self.logged_operations >= self.compact_every:
+                self.compact()
+    
+    # Record a change in the operation log, in the transaction making it. Entries hold operation names, tiers and ids, never memory
+    # text - the memories table has that, so logging it too would double every write.
+    def log(self, cursor, operation, **detail):
+        cursor.execute("INSERT INTO operation_log (operation, detail, created) VALUES (?, ?, ?)", (operation, json.dumps(detail), time.time()))
+        self.logged_operations += 1
+        return cursor.lastrowid
+    
+    def operations(self, since_seq = 0):
+        with self.lock:
+            rows = self.connection.execute("SELECT seq, operation, detail FROM operation_log WHERE seq > ? ORDER BY seq", (since_seq,)).fetchall()
+        return [(seq, operation, json.loads(detail)) for seq, operation, detail in rows]
+    
+    # Fold the operation log into the snapshot (the memories table already has every logged change) and start it over
+    def compact(self):
+        def compact_log(cursor):
+            last_seq = cursor.execute("SELECT MAX(seq) FROM operation_log").fetchone()[0]
+            if last_seq is None:
+                return None
+            cursor.execute("DELETE FROM operation_log WHERE seq <= ?", (last_seq,))
+            self.set_meta("snapshot_seq", str(last_seq), cursor)
+            self.logged_operations = 0
+            return last_seq
+        return self.transaction(compact_log)
+    
+    def insert(self, cursor, tier, memories, source, shard):
+        now = time.time()
+        ids = []
+        for memory in memories:
+            cursor.execute("INSERT INTO memories (tier, shard, content, source, created) VALUES (?, ?, ?, ?, ?)", (tier, shard, memory, source, now))
+            ids.append(cursor.lastrowid)
+            if tier in self.SEARCHABLE_TIERS:
+                self.index(cursor, ids[-1], memory)
+        self.counts[tier] += len(ids)
+        if ids:
+            self.log(cursor, "insert", tier = tier, shard = shard, source = source, ids = ids)
+        if self.instrumentation.enabled:
+            self.instrumentation.count("bytes_written", sum(len(memory.encode()) for memory in memories))
+        return ids
+    
+    # Add or remove a memory in the full text index
+    def index(self, cursor, memory_id, content):
+        if self.full_text_search:
+            cursor.execute("INSERT INTO memory_search (rowid, terms) VALUES (?, ?)", (memory_id, " ".join(tokenize_memory(content))))
+    
+    def unindex(self, cursor, memory_id):
+        if self.full_text_search:
+            cursor.execute("DELETE FROM memory_search WHERE rowid = ?", (memory_id,))
+    
+    def append(self, tier, memories, source, shard = None):
+        memories = list(memories)
+        if not memories:
+            return []
+        return self.transaction(lambda cursor: self.insert(cursor, tier, memories, source, shard))
+    
+    def read(self, tier, shard = None):
+        with self.lock:
+            if shard is None:
+                rows = self.connection.execute("SELECT id, tier, shard, content, source, created FROM memories WHERE tier = ? ORDER BY id", (tier,))
+            else:
+                rows = self.connection.execute("SELECT id, tier, shard, content, source, created FROM memories WHERE tier = ? AND shard = ? ORDER BY id", (tier, shard))
+            records = [MemoryRecord(*row) for row in rows]
+        if self.instrumentation.enabled:
+            self.instrumentation.count("bytes_read", sum(len(record.content.encode()) for record in records))
+        return records
+    
+    def count(self, tier):
+        return self.counts[tier]
+    
+    def find(self, tier, source):
+        with self.lock:
+            rows = self.connection.execute("SELECT id, tier, shard, content, source, created FROM memories WHERE tier = ? AND source = ? ORDER BY id", (tier, source))
+            records = [MemoryRecord(*row) for row in rows]
+        if self.instrumentation.enabled:
+            self.instrumentation.count("bytes_read", sum(len(record.content.encode()) for record in records))
+        return records
+    
+    def oldest_ids(self, tier, limit):
+        with self.lock:
+            return [memory_id for (memory_id,) in self.connection.execute("SELECT id FROM memories WHERE tier = ? ORDER BY id LIMIT ?", (tier, limit))]
+    
+    def replace(self, tier, memories, source, shard = None):
+        memories = list(memories)
+        def replace_rows(cursor):
+            if tier in self.SEARCHABLE_TIERS:
+                for (memory_id,) in cursor.execute("SELECT id FROM memories WHERE tier = ?" + ("" if shard is None else " AND shard = ?"), (tier,) if shard is None else (tier, shard)).fetchall():
+                    self.unindex(cursor, memory_id)
+            if shard is None:
+                cursor.execute("DELETE FROM memories WHERE tier = ?", (tier,))
+            else:
+                cursor.execute("DELETE FROM memories WHERE tier = ? AND shard = ?", (tier, shard))
+            self.counts[tier] -= cursor.rowcount
+            self.log(cursor, "clear", tier = tier, shard = shard)
+            return self.insert(cursor, tier, memories, source, shard)
+        return self.transaction(replace_rows)
+    
+    def move(self, ids, tier, shard = None):
+        ids = list(ids)
+        if not ids:
+            return
+        def move_rows(cursor):
+            self.log(cursor, "move", ids = ids, tier = tier, shard = shard)
+            for memory_id in ids:
+                old = cursor.execute("SELECT tier, content FROM memories WHERE id = ?", (memory_id,)).fetchone()
+                if old is None:
+                    continue
+                old_tier, content = old
+                cursor.execute("UPDATE memories SET tier = ?, shard = ? WHERE id = ?", (tier, shard, memory_id))
+                if old_tier in self.SEARCHABLE_TIERS and tier not in self.SEARCHABLE_TIERS:
+                    self.unindex(cursor, memory_id)
+                elif tier in self.SEARCHABLE_TIERS and old_tier not in self.SEARCHABLE_TIERS:
+                    self.index(cursor, memory_id, content)
+                self.counts[old_tier] -= 1
+                self.counts[tier] += 1
+        self.transaction(move_rows)
+    
+    def delete(self, ids):
+        ids = list(ids)
+        if not ids:
+            return
+        def delete_rows(cursor):
+            self.log(cursor, "delete", ids = ids)
+            for memory_id in ids:
+                old_tier = cursor.execute("SELECT tier FROM memories WHERE id = ?", (memory_id,)).fetchone()
+                if old_tier is None:
+                    continue
+                cursor.execute("DELETE FROM memories WHERE id = ?", (memory_id,))
+                if old_tier[0] in self.SEARCHABLE_TIERS:
+                    self.unindex(cursor, memory_id)
+                self.counts[old_tier[0]] -= 1
+        self.transaction(delete_rows)
+    
+    # Searchable tiers go through the full text index, ranked by BM25 - only the matches are read
+    def search(self, tier, query, limit = 10):
+        if tier not in self.SEARCHABLE_TIERS or not self.full_text_search:
+            return super().search(tier, query, limit)
+        terms = sorted(set(tokenize_memory(query)))
+        if not terms:
+            return []
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT m.id, m.tier, m.shard, m.content, m.source, m.created FROM memory_search JOIN memories AS m ON m.id = memory_search.rowid "
+                "WHERE memory_search MATCH ? AND m.tier = ? ORDER BY bm25(memory_search) LIMIT ?",
+                (" OR ".join(f'"{term}"' for term in terms), tier, limit),
+            )
+            records = [MemoryRecord(*row) for row in rows]
+        if self.instrumentation.enabled:
+            self.instrumentation.count("bytes_read", sum(len(record.content.encode()) for record in records))
+        return records
+    
+    def get_meta(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            return None if row is None else row[0]
+    
+    def set_meta(self, key, value, cursor = None):
+        (cursor or self.connection).execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+    
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+# One-time import of the old '|' separated text file memories (short_term_memory.txt, long_term_memory.txt and
+# long_term_memory/shard_NNN.txt) into a SQLiteMemoryStore. Imported files are renamed to *.migrated. Returns the number of memories imported.
+def migrate_text_memories(memories_path, store):
+    if store.get_meta("text_memories_migrated") is not None:
+        return 0
+    
+    def read_entries(path):
+        with open(path, 'r') as f:
+            return [m.strip() for m in f.read().split('|') if m.strip() != ""]
+    
+    stm_path = os.path.join(memories_path, "short_term_memory.txt")
+    ltm_path = os.path.join(memories_path, "long_term_memory.txt")
+    shard_dir = os.path.join(memories_path, "long_term_memory")
+    
+    # (path, tier, shard)
+    sources = []
+    if os.path.exists(stm_path):
+        sources.append((stm_path, "stm", None))
+    if os.path.isdir(shard_dir):
+        for file_name in sorted(os.listdir(shard_dir)):
+            match = re.fullmatch(r"shard_(\d+)\.txt", file_name)
+            if match is not None:
+                sources.append((os.path.join(shard_dir, file_name), "ltm", int(match.group(1))))
+    if os.path.exists(ltm_path) and not any(tier == "ltm" for _, tier, _ in sources):
+        sources.append((ltm_path, "ltm", 0))
+    
+    def import_all(cursor):
+        imported = 0
+        for path, tier, shard in sources:
+            imported += len(store.insert(cursor, tier, read_entries(path), "migration", shard))
+        store.set_meta("text_memories_migrated", str(time.time()), cursor)
+        return imported
+    imported = store.transaction(import_all)
+    
+    # Only rename once the import has committed
+    for path, tier, shard in sources:
+        os.replace(path, path + ".migrated")
+    return imported
+
+
+# Every live STM cache, so dirty memories can be written out when the interpreter exits.
+_LIVE_MEMORY_CACHES = weakref.WeakSet()
+
+# Flush whatever is still dirty on shutdown - this is what makes the 'shutdown' flush policy safe.
+@atexit.register
+def _flush_live_memory_caches():
+    for cache in list(_LIVE_MEMORY_CACHES):
+        cache.flush()
+
+
+# In-process short term memory (STM) owned by a MEA. Memories live in RAM and are written behind to the memory store.
+# Flush policies:
+#   'turn'     - flush at the end of every turn (every call to receive) and every memory job
+#   'interval' - flush when flush_interval_ms has passed since the last flush (checked on every change and every turn)
+#   'shutdown' - only flush on close() or interpreter exit
+class ShortTermMemoryCache:
+    FLUSH_POLICIES = ("turn", "interval", "shutdown")
+
+    def __init__(self, store, flush_policy = "turn", flush_interval_ms = 1000):
+        if flush_policy not in self.FLUSH_POLICIES:
+            raise ValueError(f"Unknown STM flush policy '{flush_policy}', expected one of {self.FLUSH_POLICIES}")
+
+        self.store = store
+        self.flush_policy = flush_policy
+        self.flush_interval_ms = flush_interval_ms
+
+        # Every access goes through the lock so the cache can be shared safely with memory manager work.
+        self.lock = threading.RLock()
+        
+        # Memories and their store ids (None until flushed), memories appended since the last flush, and whether STM was rewritten since
+        records = store.read("stm")
+        self.memories = [r.content for r in records]
+        self.ids = [r.id for r in records]
+        self.pending = []
+        self.rewritten = False
+        
+        self.joined = None
+        self.dirty = False
+        self.last_flush = time.monotonic()
+        self.num_flushes = 0
+
+        _LIVE_MEMORY_CACHES.add(self)
+
+    # O(1) memory count
+    def __len__(self):
+        return len(self.memories)
+
+    # Copy of the memories, oldest first
+    def as_list(self):
+        with self.lock:
+            return list(self.memories)
+
+    # Memories as a single '|' separated string, as shown to the MEA. Joined string is cached until the next change.
+    def as_string(self):
+        with self.lock:
+            if self.joined is None:
+                self.joined = "".join(f"{memory}|" for memory in self.memories)
+            return self.joined
+
+    # Add memories to the end of STM, skipping None.
+    def append(self, memories):
+        with self.lock:
+            memories = [m for m in memories if m is not None]
+            self.memories.extend(memories)
+            self.ids.extend([None]*len(memories))
+            self.pending.extend(memories)
+            self.mark_dirty()
+
+    # Replace all memories.
+    def rewrite(self, memories):
+        with self.lock:
+            self.memories = [m for m in memories if m is not None]
+            self.ids = [None]*len(self.memories)
+            self.pending = []
+            self.rewritten = True
+            self.mark_dirty()
+
+    # Take the oldest num memories out of STM and move them to another tier in one store transaction. Returns their (id, content).
+    def move_oldest(self, num, tier):
+        with self.lock:
+            self.flush()
+            moved = list(zip(self.ids[:num], self.memories[:num]))
+            self.store.move([memory_id for memory_id, _ in moved], tier)
+            del self.ids[:num]
+            del self.memories[:num]
+            self.joined = None
+            return moved
+    
+    # Put (id, content) pairs taken out by move_oldest back at the front of STM, e.g. after a failed consolidation
+    def restore(self, moved):
+        if not moved:
+            return
+        with self.lock:
+            self.flush()
+            self.store.move([memory_id for memory_id, _ in moved], "stm")
+            self.ids[:0] = [memory_id for memory_id, _ in moved]
+            self.memories[:0] = [content for _, content in moved]
+            self.joined = None
+
+    def mark_dirty(self):
+        self.joined = None
+        self.dirty = True
+        if self.flush_policy == "interval":
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        if (time.monotonic() - self.last_flush)*1000 >= self.flush_interval_ms:
+            self.flush()
+
+    # Called by the MEA once per turn and after every memory job, applies the flush policy.
+    def end_turn(self):
+        if self.flush_policy == "turn":
+            self.flush()
+        elif self.flush_policy == "interval":
+            self.flush_if_due()
+
+    # Write dirty memories to the store - a single transaction, either appending the new memories or replacing STM after a rewrite.
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return False
+            if self.rewritten:
+                self.ids = self.store.replace("stm", self.memories, "rewrite")
+            elif self.pending:
+                self.ids[len(self.ids) - len(self.pending):] = self.store.append("stm", self.pending, "summary")
+
+            self.pending = []
+            self.rewritten = False
+            self.dirty = False
+            self.last_flush = time.monotonic()
+            self.num_flushes += 1
+            return True
+
+    def close(self):
+        self.flush()
+        _LIVE_MEMORY_CACHES.discard(self)
+
+
+# Background worker for memory maintenance (chat summarization, STM->LTM consolidation), so it runs off the reply path.
+# Jobs are queued in lanes by key - one lane per agent. Jobs in the same lane run in submission order and never concurrently,
+# jobs in different lanes can run in parallel on up to num_threads threads.
+class MemoryConsolidationWorker:
+    
+    def __init__(self, num_threads = 1, max_errors = 100):
+        self.num_threads = num_threads
+        self.condition = threading.Condition()
+        
+        # key -> deque of pending jobs, keys waiting for a thread, keys currently running, pending job count per key
+        self.lanes = {}
+        self.ready = deque()
+        self.running = set()
+        self.pending = {}
+        
+        self.threads = []
+        self.stopping = False
+        self.num_completed = 0
+        
+        # The most recent failures as (sender name, repr of the exception) - nothing that would keep a partition or traceback alive
+        self.errors = deque(maxlen = max_errors)
+        self.num_errors = 0
+    
+    # Queue func(*args, **kwargs) on the lane for key. Threads are started on first use.
+    def submit(self, key, func, *args, **kwargs):
+        with self.condition:
+            if self.stopping:
+                raise RuntimeError("MemoryConsolidationWorker has been drained and no longer accepts jobs")
+            
+            lane = self.lanes.setdefault(key, deque())
+            lane.append((func, args, kwargs))
+            self.pending[key] = self.pending.get(key, 0) + 1
+            
+            # A lane is only made ready if it isn't already waiting or running - that is what keeps per-key ordering.
+            if len(lane) == 1 and key not in self.running:
+                self.ready.append(key)
+            
+            self.start_threads()
+            self.condition.notify_all()
+    
+    def start_threads(self):
+        while len(self.threads) < self.num_threads:
+            thread = threading.Thread(target = self.run, name = f"MemoryConsolidationWorker-{len(self.threads)}", daemon = True)
+            self.threads.append(thread)
+            thread.start()
+    
+    # Thread loop - take a ready lane, run its oldest job, put the lane back if it still has work.
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.ready and not self.stopping:
+                    self.condition.wait()
+                if not self.ready:
+                    return
+                key = self.ready.popleft()
+                func, args, kwargs = self.lanes[key].popleft()
+                self.running.add(key)
+            
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                # Memory maintenance must never take down the conversation - record and move on.
+                with self.condition:
+                    self.errors.append((getattr(key, "sender_name", repr(key)), repr(e)))
+                    self.num_errors += 1
+                instrumentation = self.job_instrumentation(func)
+                instrumentation.count("memory_job_errors")
+                instrumentation.debug(DEBUG_SUMMARY, lambda: f"Memory consolidation job {getattr(func, '__name__', func)} failed: {e!r}")
+            
+            with self.condition:
+                self.running.discard(key)
+                self.pending[key] -= 1
+                self.num_completed += 1
+                if self.lanes[key]:
+                    self.ready.append(key)
+                else:
+                    del self.lanes[key]
+                    del self.pending[key]
+                self.condition.notify_all()
+    
+    # Jobs are bound methods of the agent they run for (run_in_partition) - their failures are reported through its instrumentation
+    @staticmethod
+    def job_instrumentation(func):
+        return getattr(getattr(func, "__self__", None), "instrumentation", NULL_INSTRUMENTATION)
+    
+    # Number of jobs queued or running, for one key or in total
+    def num_pending(self, key = None):
+        with self.condition:
+            if key is None:
+                return sum(self.pending.values())
+            return self.pending.get(key, 0)
+    
+    # Block until every job submitted so far (for key, or for all keys) has finished. Returns False on timeout.
+    def flush(self, key = None, timeout = None):
+        if self.in_worker_thread():
+            # Waiting on our own lane from inside it would deadlock.
+            return False
+        with self.condition:
+            return self.condition.wait_for(lambda: (key not in self.pending) if key is not None else not self.pending, timeout)
+    
+    # Finish all queued jobs and stop the threads. Used at shutdown.
+    def drain(self, timeout = None):
+        finished = self.flush(timeout = timeout)
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout)
+        return finished
+    
+    def in_worker_thread(self):
+        return threading.current_thread() in self.threads
+
+
+# Shared worker used by every MEA unless one is given explicitly.
+_DEFAULT_CONSOLIDATION_WORKER = None
+_DEFAULT_CONSOLIDATION_WORKER_LOCK = threading.Lock()
+
+def get_consolidation_worker():
+    global _DEFAULT_CONSOLIDATION_WORKER
+    with _DEFAULT_CONSOLIDATION_WORKER_LOCK:
+        if _DEFAULT_CONSOLIDATION_WORKER is None:
+            _DEFAULT_CONSOLIDATION_WORKER = MemoryConsolidationWorker(num_threads = MemoryEnabledAgent.DEFAULT_CONSOLIDATION_THREADS)
+        return _DEFAULT_CONSOLIDATION_WORKER
+
+# Registered after the STM cache hook, so it runs first at exit: finish consolidation, then flush the resulting STM.
+@atexit.register
+def _drain_default_consolidation_worker():
+    if _DEFAULT_CONSOLIDATION_WORKER is not None:
+        _DEFAULT_CONSOLIDATION_WORKER.drain()
+
+
+# Words that carry no meaning for memory retrieval
+MEMORY_STOPWORDS = frozenset("""
+a about above after again all am an and any are as at be because been before being below between both but by can could
+did do does doing down during each few for from further had has have having he her here hers herself him himself his how
+i if in into is it its itself just know me more most my myself no nor not now of off on once only or other our ours out
+over own remember same she should so some such than that the their theirs them then there these they this those through
+to too under until up very was we were what when where which while who whom why will with would you your yours
+""".split())
+
+# Negations are stopwords for retrieval, but change what a memory says - duplicate detection keeps them
+MEMORY_NEGATIONS = frozenset(("no", "nor", "not"))
+
+# Lowercase, lightly stemmed word tokens without stopwords (other than those in keep) - shared by all local memory retrieval.
+def tokenize_memory(text, keep = frozenset()):
+    tokens = []
+    for token in re.findall(r"[a-z0-9]+", text.lower()):
+        if (token in MEMORY_STOPWORDS and token not in keep) or (len(token) == 1 and not token.isdigit()):
+            continue
+        # Plurals match singulars: dogs -> dog, allergies -> allergy. Leave short words and 'ss' endings alone.
+        if len(token) > 4 and token.endswith("ies"):
+            token = token[:-3] + "y"
+        elif len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+# Memory text reduced to its words - memories that only differ in case, spacing or punctuation are exact repeats
+def normalize_memory(text):
+    return " ".join(re.findall(r"[a-z0-9]+", text.lower()))
+
+# Word and word pair shingles of a memory, for near duplicate detection. Memoized - STM and LTM entries are compared again and again.
+@functools.lru_cache(maxsize = 4096)
+def memory_shingles(text):
+    tokens = tokenize_memory(text, keep = MEMORY_NEGATIONS)
+    return frozenset(tokens) | frozenset(f"{a} {b}" for a, b in zip(tokens, tokens[1:]))
+
+def shingle_similarity(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b)/len(a | b)
+
+
+# Tokenizers by model, loaded once. False means tiktoken could not provide one and the estimate is used.
+_TOKEN_ENCODINGS = {}
+
+# Count tokens in text with the models tokenizer. Falls back to an estimate of ~4 characters per token without tiktoken.
+def count_tokens(text, model = "gpt-3.5-turbo"):
+    if not text:
+        return 0
+    
+    encoding = _TOKEN_ENCODINGS.get(model)
+    if encoding is None:
+        encoding = False
+        if tiktoken is not None:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception:
+                # Encodings are downloaded on first use - no network means no tokenizer
+                encoding = False
+        _TOKEN_ENCODINGS[model] = encoding
+    
+    if encoding:
+        return len(encoding.encode(text, disallowed_special = ()))
+    return (len(text) + 3)//4
+
+# Tokens a chat message takes up in the prompt, including the per message overhead of the chat format.
+def count_message_tokens(message, model = "gpt-3.5-turbo"):
+    tokens = 4 + count_tokens(str(message.get("content") or ""), model)
+    if message.get("name"):
+        tokens += count_tokens(message["name"], model)
+    function_call = message.get("function_call")
+    if function_call:
+        tokens += count_tokens(function_call.get("name", ""), model) + count_tokens(function_call.get("arguments", ""), model)
+    return tokens
+
+# Speaker labels in rendered transcripts, by message role
+TRANSCRIPT_SPEAKERS = {"user": "User", "assistant": "Assistant", "system": "System"}
+
+# Compact transcript of chat messages, for prompts - one "Speaker: content" line per message instead of the repr of the message dicts.
+# Messages with no content are skipped. Function results over max_function_tokens are cut to their start, followed by how much was
+# cut and a digest of the full result. Returns the transcript and {digest: full result} for the results that were cut.
+def render_transcript(messages, max_function_tokens = 200, model = "gpt-3.5-turbo"):
+    lines = []
+    digested = {}
+    for message in messages:
+        content = str(message.get("content") or "").strip()
+        if not content:
+            continue
+        role = message.get("role", "user")
+        if role == "function":
+            speaker = f"Function {message.get('name', '')}".rstrip()
+            tokens = count_tokens(content, model) if max_function_tokens is not None else 0
+            if max_function_tokens is not None and tokens > max_function_tokens:
+                digest = hashlib.sha1(content.encode()).hexdigest()[:16]
+                digested[digest] = content
+                content = f"{content[:len(content)*max_function_tokens//tokens].rstrip()} [{tokens - max_function_tokens} more tokens, digest {digest}]"
+        else:
+            speaker = TRANSCRIPT_SPEAKERS.get(role, role.capitalize())
+        # Continuation lines are indented, so a line starting with a speaker label is always a new message
+        lines.append(f"{speaker}: " + "\n  ".join(line.rstrip() for line in content.splitlines() if line.strip()))
+    return "\n".join(lines), digested
+
+# Python types for the JSON schema types used in function definitions
+JSON_SCHEMA_TYPES = {"string": str, "integer": int, "number": (int, float), "boolean": bool, "array": list, "object": dict}
+
+# Where value doesn't match a function definitions JSON schema - a description of the first mismatch, or None if it matches.
+# Checks types, required properties and array items, which is all the memory functions use.
+def schema_mismatch(value, schema, path = "arguments"):
+    expected = JSON_SCHEMA_TYPES.get(schema.get("type"))
+    if expected is not None and (not isinstance(value, expected) or (isinstance(value, bool) and schema.get("type") != "boolean")):
+        return f"{path} should be {schema['type']}, got {type(value).__name__}"
+    if isinstance(value, dict):
+        for name in schema.get("required", ()):
+            if name not in value:
+                return f"{path} is missing {name}"
+        for name, property_schema in schema.get("properties", {}).items():
+            if name in value:
+                mismatch = schema_mismatch(value[name], property_schema, f"{path}.{name}")
+                if mismatch:
+                    return mismatch
+    if isinstance(value, list) and "items" in schema:
+        for number, item in enumerate(value):
+            mismatch = schema_mismatch(item, schema["items"], f"{path}[{number}]")
+            if mismatch:
+                return mismatch
+    return None
+
+
+# Local BM25 index over long term memory entries. Runs with no network.
+# Entries are keyed by their text and kept in numbered slots, so postings and document lengths map onto NumPy arrays
+# for scoring. Adding or removing an entry only touches that entries terms - no rebuild on LTM rewrites.
+class LongTermMemoryIndex:
+    
+    def __init__(self, k1 = 1.5, b = 0.75):
+        self.k1 = k1
+        self.b = b
+        
+        # Searched on the reply path while memory jobs update it
+        self.lock = threading.RLock()
+        
+        # entry text -> slot, slot -> entry text, term -> {slot: term frequency}
+        self.slots = {}
+        self.texts = []
+        self.postings = {}
+        
+        self.lengths = np.zeros(16)
+        self.free_slots = []
+        self.total_length = 0
+    
+    def __len__(self):
+        return len(self.slots)
+    
+    def __contains__(self, text):
+        return text.strip() in self.slots
+    
+    def add(self, text):
+        text = text.strip()
+        with self.lock:
+            if text == "" or text in self.slots:
+                return False
+        
+            # Reuse a freed slot if there is one, otherwise grow the length array
+            if self.free_slots:
+                slot = self.free_slots.pop()
+                self.texts[slot] = text
+            else:
+                slot = len(self.texts)
+                self.texts.append(text)
+                if slot >= len(self.lengths):
+                    self.lengths = np.concatenate([self.lengths, np.zeros(len(self.lengths))])
+        
+            terms = Counter(tokenize_memory(text))
+            for term, tf in terms.items():
+                self.postings.setdefault(term, {})[slot] = tf
+            length = sum(terms.values())
+            self.lengths[slot] = length
+            self.total_length += length
+            self.slots[text] = slot
+            return True
+    
+    def remove(self, text):
+        with self.lock:
+            slot = self.slots.pop(text.strip(), None)
+            if slot is None:
+                return False
+        
+            for term in set(tokenize_memory(self.texts[slot])):
+                posting = self.postings[term]
+                del posting[slot]
+                if not posting:
+                    del self.postings[term]
+            self.total_length -= self.lengths[slot]
+            self.lengths[slot] = 0
+            self.texts[slot] = None
+            self.free_slots.append(slot)
+            return True
+    
+    # Bring the index in line with a full list of entries, only adding and removing the difference.
+    def sync(self, entries):
+        wanted = set(e.strip() for e in entries if e is not None and e.strip() != "")
+        with self.lock:
+            for text in [t for t in self.slots if t not in wanted]:
+                self.remove(text)
+            for text in wanted:
+                self.add(text)
+    
+    # BM25 inverse document frequency of a term
+    def idf(self, term):
+        n = len(self.slots)
+        df = len(self.postings.get(term, ()))
+        return math.log(1 + (n - df + 0.5)/(df + 0.5))
+    
+    # Top k entries for query as (score, confidence, text), best first. Entries with no query terms are never returned.
+    # Confidence is the idf weighted share of the query terms an entry contains, 0 to 1. Terms found in more than half the entries
+    # (like the users name) don't discriminate, so they are left out of confidence - a query of only common terms has confidence 0.
+    def search(self, query, k = 5):
+        query_terms = set(tokenize_memory(query))
+        if not query_terms or not self.slots:
+            return []
+        
+        with self.lock:
+            num_slots = len(self.texts)
+            scores = np.zeros(num_slots)
+            matched_weight = np.zeros(num_slots)
+            avg_length = self.total_length/len(self.slots) or 1
+            lengths = self.lengths[:num_slots]
+        
+            query_weight = 0
+            for term in query_terms:
+                idf = self.idf(term)
+                posting = self.postings.get(term, {})
+                discriminative = len(posting)*2 <= len(self.slots)
+                if discriminative:
+                    query_weight += idf
+                if not posting:
+                    continue
+            
+                slots = np.fromiter(posting.keys(), dtype = np.int64, count = len(posting))
+                tfs = np.fromiter(posting.values(), dtype = np.float64, count = len(posting))
+                norm = self.k1*(1 - self.b + self.b*lengths[slots]/avg_length)
+                scores[slots] += idf*tfs*(self.k1 + 1)/(tfs + norm)
+                if discriminative:
+                    matched_weight[slots] += idf
+        
+            candidates = np.flatnonzero(scores)
+            if len(candidates) > k:
+                candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+            candidates = candidates[np.argsort(-scores[candidates], kind = "stable")]
+        
+            return [(float(scores[slot]), float(matched_weight[slot]/query_weight) if query_weight else 0.0, self.texts[slot]) for slot in candidates]
+
+
+# Long term memory (LTM) split into topic shards, kept in the memory store as the 'ltm' tier.
+# New memories are routed to the most similar shard by TF-IDF cosine similarity against each shards term centroid, so a
+# consolidation only has to rewrite the shards it touches. Shards that grow past max_entries are split in two locally.
+# Token totals and last use of every entry are tracked, so the coldest entries can be moved to the archive tier to keep LTM bounded.
+class LongTermMemoryShards:
+    
+    def __init__(self, store, max_entries = 20, routing_threshold = 0.15, count_tokens = count_tokens):
+        self.store = store
+        self.max_entries = max_entries
+        self.routing_threshold = routing_threshold
+        self.count_tokens = count_tokens
+        
+        # Looked up and touched on the reply path while memory jobs rewrite shards. Taken before the stores lock when both are needed.
+        self.lock = threading.RLock()
+        
+        # shard id -> tokens of its entries, and the total
+        self.shard_tokens = {}
+        self.num_tokens = 0
+        
+        # entry -> use clock reading when it was last written (added or changed) or looked up. Entries loaded from the store start at 0.
+        self.last_used = {}
+        self.use_clock = 0
+        
+        # shard id -> entries, shard id -> summed term counts of its entries, term -> number of entries containing it
+        self.shards = {}
+        self.term_counts = {}
+        self.document_frequency = Counter()
+        self.num_entries = 0
+        self.next_shard_id = 0
+        
+        # Bumped on every change, and the content hash for the version it was computed at
+        self.version = 0
+        self.hashed_version = None
+        self.hash = None
+        
+        self.load()
+    
+    # Read every shard from the store once
+    def load(self):
+        shards = {}
+        for record in self.store.read("ltm"):
+            shards.setdefault(record.shard or 0, []).append(record.content)
+        for shard_id, entries in shards.items():
+            self.set(shard_id, entries, write = False)
+    
+    def __len__(self):
+        return self.num_entries
+    
+    # All entries, shard by shard
+    def entries(self):
+        with self.lock:
+            return [entry for shard_id in sorted(self.shards) for entry in self.shards[shard_id]]
+    
+    def get(self, shard_id):
+        with self.lock:
+            return list(self.shards.get(shard_id, []))
+    
+    # Hash of the full LTM contents, recomputed only after a change
+    def content_hash(self):
+        with self.lock:
+            if self.hashed_version != self.version:
+                self.hash = hashlib.sha1("\x1f".join(self.entries()).encode()).hexdigest()
+                self.hashed_version = self.version
+            return self.hash
+    
+    # Replace the entries of one shard, keeping centroids and document frequencies in step. An emptied shard is removed.
+    def set(self, shard_id, entries, write = True):
+        with self.lock:
+            entries = [e.strip() for e in entries if e is not None and e.strip() != ""]
+            
+            previously_used = {}
+            for entry in self.shards.pop(shard_id, []):
+                self.document_frequency.subtract(set(tokenize_memory(entry)))
+                self.num_entries -= 1
+                previously_used[entry] = self.last_used.pop(entry, 0)
+            self.term_counts.pop(shard_id, None)
+            self.num_tokens -= self.shard_tokens.pop(shard_id, 0)
+            
+            if entries:
+                self.shards[shard_id] = entries
+                centroid = Counter()
+                if write:
+                    self.use_clock += 1
+                for entry in entries:
+                    terms = tokenize_memory(entry)
+                    centroid.update(terms)
+                    self.document_frequency.update(set(terms))
+                    # Entries the rewrite kept as they were keep their last use
+                    self.last_used[entry] = previously_used.get(entry, self.use_clock if write else 0)
+                self.term_counts[shard_id] = centroid
+                self.num_entries += len(entries)
+                self.shard_tokens[shard_id] = sum(self.count_tokens(entry) for entry in entries)
+                self.num_tokens += self.shard_tokens[shard_id]
+            self.document_frequency += Counter()  # drop terms that reached 0
+            self.next_shard_id = max(self.next_shard_id, shard_id + 1)
+            self.version += 1
+            
+            if write:
+                self.store.replace("ltm", entries, "consolidation", shard = shard_id)
+    
+    def new_shard(self, entries):
+        with self.lock:
+            shard_id = self.next_shard_id
+            self.set(shard_id, entries)
+            return shard_id
+    
+    # Mark entries as used by a lookup
+    def touch(self, entries):
+        with self.lock:
+            self.use_clock += 1
+            for entry in entries:
+                if entry in self.last_used:
+                    self.last_used[entry] = self.use_clock
+    
+    # Move the least recently used entries (oldest shards first among equals) to the archive tier until LTM is within max_tokens.
+    # Returns the archived entries.
+    def archive_coldest(self, max_tokens):
+        with self.lock:
+            if max_tokens is None or self.num_tokens <= max_tokens:
+                return []
+            
+            ranked = sorted((self.last_used.get(entry, 0), shard_id, position, entry) for shard_id, entries in self.shards.items() for position, entry in enumerate(entries))
+            excess = self.num_tokens - max_tokens
+            cold = defaultdict(set)
+            archived = []
+            for _, shard_id, position, entry in ranked:
+                if excess <= 0:
+                    break
+                cold[shard_id].add(position)
+                archived.append(entry)
+                excess -= self.count_tokens(entry)
+            
+            # Archive first - a crash in between leaves an entry in both tiers, never in neither
+            self.store.append("archive", archived, "archive")
+            for shard_id, positions in cold.items():
+                self.set(shard_id, [entry for position, entry in enumerate(self.shards[shard_id]) if position not in positions])
+            return archived
+    
+    # Sparse TF-IDF vector (term -> weight) for a bag of terms
+    def vector(self, term_counts):
+        n = self.num_entries
+        return {t: c*(math.log((1 + n)/(1 + self.document_frequency.get(t, 0))) + 1) for t, c in term_counts.items()}
+    
+    @staticmethod
+    def cosine(a, b):
+        if len(a) > len(b):
+            a, b = b, a
+        dot = sum(w*b.get(t, 0) for t, w in a.items())
+        if dot == 0:
+            return 0.0
+        return dot/(math.sqrt(sum(w*w for w in a.values()))*math.sqrt(sum(w*w for w in b.values())))
+    
+    # Group new memories by the shard they belong to. Memories not similar enough to any shard are grouped under None,
+    # meaning they start a new shard together.
+    def route(self, memories):
+        with self.lock:
+            centroids = {shard_id: self.vector(counts) for shard_id, counts in self.term_counts.items()}
+            routes = {}
+            for memory in memories:
+                if memory is None or memory.strip() == "":
+                    continue
+                vector = self.vector(Counter(tokenize_memory(memory)))
+                best_id, best_similarity = None, 0.0
+                for shard_id, centroid in centroids.items():
+                    similarity = self.cosine(vector, centroid)
+                    if similarity > best_similarity:
+                        best_id, best_similarity = shard_id, similarity
+                if best_similarity < self.routing_threshold:
+                    best_id = None
+                routes.setdefault(best_id, []).append(memory.strip())
+            return routes
+    
+    # Split an oversized shard in two with a few rounds of 2-means over entry TF-IDF vectors, repeating until every piece fits.
+    # Returns the ids of the new shards.
+    def split_if_oversized(self, shard_id):
+        with self.lock:
+            entries = self.shards.get(shard_id, [])
+            if len(entries) <= self.max_entries:
+                return []
+            
+            vectors = [self.vector(Counter(tokenize_memory(e))) for e in entries]
+            # Seeds: the first entry, and the entry least like it
+            seeds = [vectors[0], min(vectors[1:], key = lambda v: self.cosine(vectors[0], v))]
+            for _ in range(5):
+                groups = [[], []]
+                for i, vector in enumerate(vectors):
+                    groups[0 if self.cosine(vector, seeds[0]) >= self.cosine(vector, seeds[1]) else 1].append(i)
+                if not groups[0] or not groups[1]:
+                    break
+                seeds = [sum((Counter(vectors[i]) for i in group), Counter()) for group in groups]
+            
+            # No useful topic structure to split on - fall back to older half / newer half
+            if min(len(groups[0]), len(groups[1])) < len(entries)//4:
+                groups = [list(range(len(entries)//2)), list(range(len(entries)//2, len(entries)))]
+            
+            self.set(shard_id, [entries[i] for i in groups[0]])
+            new_shard_id = self.new_shard([entries[i] for i in groups[1]])
+            return [new_shard_id] + self.split_if_oversized(shard_id) + self.split_if_oversized(new_shard_id)
+
+
+# A MEAs chat context with one sender - what AutoGen sees as chat_messages[sender]. Slot 0 is pinned for the STM header, the rest is
+# the conversation, oldest first. Function call messages are dropped as they arrive (the 'function' role result is kept), each
+# messages token count is kept alongside it so the window total is always known, and the oldest messages are evicted in O(k).
+# It reads like a list, but only changes through append, extend, pin, evict and clear, so the token counts always stay in step.
+class ChatWindow(Sequence):
+    
+    def __init__(self, count_tokens, messages = ()):
+        self.count_tokens = count_tokens
+        self.messages = deque()
+        self.tokens = deque()
+        self.total_tokens = 0
+        self.extend(messages)
+    
+    def __len__(self):
+        return len(self.messages)
+    
+    def __iter__(self):
+        return iter(self.messages)
+    
+    # Slices come back as lists, like the list AutoGen normally keeps
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self.messages)[index]
+        return self.messages[index]
+    
+    # AutoGen prepends the system message with list + messages
+    def __radd__(self, other):
+        return other + list(self.messages)
+    
+    def __eq__(self, other):
+        if isinstance(other, ChatWindow):
+            other = other.messages
+        return isinstance(other, (list, deque)) and list(self.messages) == list(other)
+    
+    def __repr__(self):
+        return f"ChatWindow({list(self.messages)!r})"
+    
+    # A copy shares count_tokens and the message dicts, like list.copy
+    def copy(self):
+        window = ChatWindow(self.count_tokens)
+        window.messages = self.messages.copy()
+        window.tokens = self.tokens.copy()
+        window.total_tokens = self.total_tokens
+        return window
+    
+    __copy__ = copy
+    
+    def append(self, message):
+        # A function call is only the request - the 'function' role message that follows holds the result worth keeping
+        if "function_call" in message:
+            return
+        tokens = self.count_tokens(message)
+        self.messages.append(message)
+        self.tokens.append(tokens)
+        self.total_tokens += tokens
+    
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+    
+    # Put message in the pinned slot. Returns False if it was already there.
+    def pin(self, message):
+        if not self.messages:
+            self.append(message)
+            return True
+        if self.messages[0] == message:
+            return False
+        tokens = self.count_tokens(message)
+        self.total_tokens += tokens - self.tokens[0]
+        self.messages[0] = message
+        self.tokens[0] = tokens
+        return True
+    
+    # Remove and return the k oldest messages after the pinned slot
+    def evict(self, k):
+        k = max(0, min(k, len(self.messages) - 1))
+        if not k:
+            return []
+        pinned, pinned_tokens = self.messages.popleft(), self.tokens.popleft()
+        evicted = [self.messages.popleft() for _ in range(k)]
+        self.total_tokens -= sum(self.tokens.popleft() for _ in range(k))
+        self.messages.appendleft(pinned)
+        self.tokens.appendleft(pinned_tokens)
+        return evicted
+    
+    def clear(self):
+        self.messages.clear()
+        self.tokens.clear()
+        self.total_tokens = 0
+
+
+# Memoizing cache for memory manager results. Entries expire after ttl_seconds, and the least recently used entries are
+# evicted once the cache holds more than max_bytes. Keys are (scope, ...) tuples so a whole scope can be invalidated at once.
+class MemoryCallCache:
+    
+    def __init__(self, max_bytes = 1 << 20, ttl_seconds = 600):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        
+        # key -> (expiry time, size in bytes, value), least recently used first
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    # Cached value for key, or None. Counts a hit or a miss.
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self.remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+    
+    def put(self, key, value):
+        size = len(repr(key).encode()) + len(repr(value).encode())
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl_seconds, size, value)
+            self.size_bytes += size
+            while self.size_bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+    
+    def remove(self, key):
+        expiry, size, value = self.entries.pop(key)
+        self.size_bytes -= size
+    
+    # Drop every entry whose key starts with scope
+    def invalidate(self, scope):
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == scope]:
+                self.remove(key)
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits/lookups if lookups else 0.0,
+                "entries": len(self.entries),
+                "bytes": self.size_bytes,
+                "evictions": self.evictions,
+            }
+
+
+# Sets the chat and STM compression ratios of an agent. With DEFAULT_ADAPTIVE_COMPRESSION the ratios start at the agents
+# DEFAULT_COMPRESSION_RATIO_* and are adjusted every DEFAULT_COMPRESSION_ADJUST_EVERY turns from measured cost: reply context,
+# summarize and consolidate tokens per turn, tokens per trimmed message, consolidations per turn, STM growth and turn latency.
+# A higher chat ratio means a smaller context and fewer, larger summarize calls; a higher STM ratio means fewer consolidations,
+# each re-sending its shards once. Each ratio is scaled by how far tokens per turn are from DEFAULT_COMPRESSION_TARGET_TOKENS_PER_TURN,
+# weighted by the share of the cost it controls - over the target they go up, under it they go down and more is remembered verbatim.
+# Turns slower than DEFAULT_COMPRESSION_TARGET_TURN_MS raise the chat ratio. Ratios move at most MAX_STEP per adjustment and stay
+# within DEFAULT_COMPRESSION_RATIO_BOUNDS.
+# The loop guards apply with fixed ratios too: every trim gets back within its limit and removes something, and a sender whose
+# consolidations fail waits for more new memories before the next attempt, instead of retrying on every append.
+class CompressionController:
+    
+    # Most a ratio changes by in one adjustment, as a factor
+    MAX_STEP = 1.25
+    
+    # Costs within this proportion of the target leave the ratios alone
+    DEADBAND = 0.1
+    
+    # Weight of the newest measurements in the smoothed per turn rates
+    SMOOTHING = 0.5
+    
+    # Window totals kept as per turn rates
+    RATES = ("context_tokens", "summarize_tokens", "summarize_content_tokens", "trimmed_messages", "consolidate_tokens", "consolidations", "consolidation_failures", "memories_added", "turn_ms")
+    
+    def __init__(self, agent):
+        self.agent = agent
+        self.lock = threading.Lock()
+        self.chat_ratio = agent.DEFAULT_COMPRESSION_RATIO_CHAT
+        self.stm_ratio = agent.DEFAULT_COMPRESSION_RATIO_STM
+        
+        # Totals since the last adjustment, and smoothed per turn rates over earlier windows
+        self.window = Counter()
+        self.rates = {}
+        self.adjustments = 0
+        self.deferred = 0
+        
+        # partition -> (memories added since its last consolidation, consolidations failed in a row)
+        self.guards = weakref.WeakKeyDictionary()
+    
+    # Messages to trim when the chat is over DEFAULT_MAX_CONVO_LENGTH. At least enough to get back within the cap.
+    def chat_trim_count(self, num_messages):
+        return max(int(num_messages*self.chat_ratio) - 1, num_messages - self.agent.DEFAULT_MAX_CONVO_LENGTH)
+    
+    # Proportion of the context budget that token trimming cuts back to - DEFAULT_CONTEXT_LOW_WATERMARK at the configured chat ratio,
+    # lower for a higher ratio
+    def chat_low_watermark(self):
+        high, low = self.agent.DEFAULT_CONTEXT_HIGH_WATERMARK, self.agent.DEFAULT_CONTEXT_LOW_WATERMARK
+        if not self.agent.DEFAULT_COMPRESSION_RATIO_CHAT:
+            return low
+        return max(0.0, high - (high - low)*self.chat_ratio/self.agent.DEFAULT_COMPRESSION_RATIO_CHAT)
+    
+    # Memories to move from STM to LTM. Always at least one, and always back within DEFAULT_SHORT_TERM_MEMORY_LIMIT, so a
+    # consolidation can't leave STM full for the next append to consolidate again.
+    def stm_trim_count(self, num_memories):
+        return min(num_memories, max(int(num_memories*self.stm_ratio), num_memories - self.agent.DEFAULT_SHORT_TERM_MEMORY_LIMIT, 1))
+    
+    # Whether partition may consolidate now. After n failures in a row, it waits for DEFAULT_SHORT_TERM_MEMORY_LIMIT*2**(n-1) new memories.
+    def allow_consolidation(self, partition):
+        with self.lock:
+            added, failures = self.guards.get(partition, (0, 0))
+            allowed = not failures or added >= self.agent.DEFAULT_SHORT_TERM_MEMORY_LIMIT*2**min(failures - 1, 6)
+            self.deferred += not allowed
+            return allowed
+    
+    def record_consolidation(self, partition, succeeded):
+        with self.lock:
+            added, failures = self.guards.get(partition, (0, 0))
+            self.guards[partition] = (0, 0 if succeeded else failures + 1)
+            self.window["consolidations"] += 1
+            self.window["consolidation_failures"] += not succeeded
+    
+    def record_memories(self, partition, num_memories):
+        with self.lock:
+            added, failures = self.guards.get(partition, (0, 0))
+            self.guards[partition] = (added + num_memories, failures)
+            self.window["memories_added"] += num_memories
+    
+    # One summarize call - tokens sent, and how many of them were the trimmed messages themselves
+    def record_summarize(self, num_messages, tokens, content_tokens):
+        with self.lock:
+            self.window["trimmed_messages"] += num_messages
+            self.window["summarize_tokens"] += tokens
+            self.window["summarize_content_tokens"] += content_tokens
+    
+    # One shard rewrite - tokens sent and the rewritten shard
+    def record_consolidate(self, tokens):
+        with self.lock:
+            self.window["consolidate_tokens"] += tokens
+    
+    # End of a turn, with the tokens of the context the reply was generated from. Adjusts the ratios every DEFAULT_COMPRESSION_ADJUST_EVERY turns.
+    def record_turn(self, seconds, context_tokens):
+        with self.lock:
+            self.window["turns"] += 1
+            self.window["turn_ms"] += seconds*1000
+            self.window["context_tokens"] += context_tokens
+            if self.window["turns"] >= self.agent.DEFAULT_COMPRESSION_ADJUST_EVERY:
+                self.adjust()
+    
+    # Fold the window into the smoothed rates and, if adaptive, move the ratios toward the targets - total tokens and turn time, and
+    # the cost per trimmed message of summarizing and STM growth against consolidation. Called with the lock held.
+    def adjust(self):
+        turns = self.window["turns"]
+        for name in self.RATES:
+            rate = self.window[name]/turns
+            self.rates[name] = rate if name not in self.rates else self.SMOOTHING*rate + (1 - self.SMOOTHING)*self.rates[name]
+        self.window.clear()
+        if not self.agent.DEFAULT_ADAPTIVE_COMPRESSION:
+            return
+        
+        chat_scale = stm_scale = 1.0
+        target_tokens = self.agent.DEFAULT_COMPRESSION_TARGET_TOKENS_PER_TURN
+        cost = self.tokens_per_turn()
+        if target_tokens is not None and cost and abs(cost - target_tokens) > target_tokens*self.DEADBAND:
+            # Trimmed messages are summarized whatever the ratio, so they count toward neither share
+            chat_share = (self.rates["context_tokens"] + self.rates["summarize_tokens"] - self.rates["summarize_content_tokens"])/cost
+            stm_share = self.rates["consolidate_tokens"]/cost
+            chat_scale = (cost/target_tokens)**chat_share
+            stm_scale = (cost/target_tokens)**stm_share
+        
+        target_ms = self.agent.DEFAULT_COMPRESSION_TARGET_TURN_MS
+        if target_ms is not None and self.rates["turn_ms"] > target_ms*(1 + self.DEADBAND):
+            chat_scale = max(chat_scale, self.rates["turn_ms"]/target_ms)
+        
+        # Summarize calls whose fixed prompt costs more per trimmed message than the message itself - trim more at a time, for fewer calls
+        content = self.rates["summarize_content_tokens"]
+        overhead = self.rates["summarize_tokens"] - content
+        if content and overhead > content*(1 + self.DEADBAND):
+            chat_scale = max(chat_scale, overhead/content)
+        
+        # STM growing faster than successful consolidations move memories out of it - move more per consolidation
+        succeeded = self.rates["consolidations"] - self.rates["consolidation_failures"]
+        moved = succeeded*self.stm_trim_count(self.agent.DEFAULT_SHORT_TERM_MEMORY_LIMIT + 1)
+        if succeeded > 0 and self.rates["memories_added"] > moved*(1 + self.DEADBAND):
+            stm_scale = max(stm_scale, self.rates["memories_added"]/moved)
+        
+        low, high = self.agent.DEFAULT_COMPRESSION_RATIO_BOUNDS
+        def step(ratio, scale):
+            return min(high, max(low, ratio*min(self.MAX_STEP, max(1/self.MAX_STEP, scale))))
+        self.chat_ratio = step(self.chat_ratio, chat_scale)
+        self.stm_ratio = step(self.stm_ratio, stm_scale)
+        self.adjustments += 1
+    
+    # Smoothed LLM tokens per turn - reply context, summarizing and consolidating
+    def tokens_per_turn(self):
+        return sum(self.rates.get(name, 0.0) for name in ("context_tokens", "summarize_tokens", "consolidate_tokens"))
+    
+    def stats(self):
+        with self.lock:
+            rates = dict(self.rates)
+            return {
+                "chat_ratio": self.chat_ratio,
+                "stm_ratio": self.stm_ratio,
+                "adjustments": self.adjustments,
+                "tokens_per_turn": self.tokens_per_turn(),
+                "upkeep_tokens_per_turn": rates.get("summarize_tokens", 0.0) + rates.get("consolidate_tokens", 0.0),
+                "summarize_tokens_per_trimmed_message": rates["summarize_tokens"]/rates["trimmed_messages"] if rates.get("trimmed_messages") else 0.0,
+                "consolidations_per_turn": rates.get("consolidations", 0.0),
+                "stm_growth_per_turn": rates.get("memories_added", 0.0),
+                "turn_ms": rates.get("turn_ms", 0.0),
+                "consolidations_deferred": self.deferred,
+            }
+
+
+# Memory managers shared by many MEAs. Each memory operation borrows an idle manager for its duration, so a fleet of agents holds
+# at most size managers per LLM config instead of one each, and at most size operations per config talk to the LLM at once.
+# A manager serves one borrower at a time, so it is thread-safe as long as it is only reached through borrow().
+class MemoryManagerPool:
+    
+    def __init__(self, size = 4, lookup_cache_max_bytes = 1 << 20, lookup_cache_ttl_seconds = 600):
+        self.size = size
+        self.lock = threading.Lock()
+        
+        # Per LLM config: idle managers, and a semaphore limiting borrowed ones to size
+        self.idle = defaultdict(list)
+        self.available = {}
+        self.created = 0
+        
+        # Managers held by this thread, per agent - memory jobs run inline from inside another one reuse the manager instead of waiting on the pool
+        self.held = threading.local()
+        
+        # One lookup cache for every manager in the pool, so hits don't depend on which manager is lent out
+        self.lookup_cache = MemoryCallCache(max_bytes = lookup_cache_max_bytes, ttl_seconds = lookup_cache_ttl_seconds)
+    
+    # Lend a manager to agent, created for its LLM config on first need, with agent as its parent until it is returned
+    @contextlib.contextmanager
+    def borrow(self, agent):
+        held = self.held.__dict__.setdefault("managers", {})
+        if agent in held:
+            yield held[agent]
+            return
+        
+        key = json.dumps(agent.gpt_config, sort_keys = True, default = str)
+        with self.lock:
+            available = self.available.setdefault(key, threading.BoundedSemaphore(self.size))
+        with available:
+            with self.lock:
+                manager = self.idle[key].pop() if self.idle[key] else None
+                if manager is None:
+                    self.created += 1
+                    name = f"MemoryManager_{self.created}"
+            if manager is None:
+                manager = MemoryEnabledAgent_Manager(parent_agent = agent, name = name, lookup_cache = self.lookup_cache)
+            manager.parent_agent = agent
+            held[agent] = manager
+            try:
+                yield manager
+            finally:
+                del held[agent]
+                with self.lock:
+                    self.idle[key].append(manager)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                "managers": self.created,
+                "idle": sum(len(managers) for managers in self.idle.values()),
+                "lookup_cache": self.lookup_cache.stats(),
+            }
+
+
+# One chat section waiting to be summarized by a MemoryBatchScheduler. Rendered when submitted, so batches can be sized in tokens.
+class MemoryBatchJob:
+    
+    def __init__(self, agent, partition, lost_messages):
+        self.agent = agent
+        self.partition = partition
+        self.lost_messages = lost_messages
+        self.transcript, self.digested = render_transcript(lost_messages, agent.DEFAULT_SUMMARY_FUNCTION_OUTPUT_TOKENS, agent.llm_model)
+        self.tokens = count_tokens(self.transcript, agent.llm_model)
+        self.config_key = json.dumps(agent.gpt_config, sort_keys = True, default = str)
+        self.submitted = time.monotonic()
+        self.done = threading.Event()
+    
+    # Block until the jobs memories are in STM, or queued on the agents memory lane with background memory. Returns False on timeout.
+    def wait(self, timeout = None):
+        return self.done.wait(timeout)
+
+
+# Summarizes chat sections from many MEAs in shared LLM calls. Jobs wait up to window_ms for others to join, then up to max_batch_jobs
+# sections (same LLM config, at most max_batch_tokens of transcript) go to a memory manager in one request, which answers with the
+# memories of each section. A section the manager gives no result for is summarized on its own, as is a batch of one.
+# Jobs for one memory partition are never in flight together and their memories reach STM in the order they were submitted, on the
+# partitions lane of the consolidation worker if the agent has one. At most max_calls_per_minute batches are sent (None for no limit),
+# and submit blocks while max_pending jobs are waiting, so a fleet that trims faster than memory can keep up is slowed down instead
+# of queueing without bound.
+class MemoryBatchScheduler:
+    
+    def __init__(self, window_ms = 50, max_batch_jobs = 8, max_batch_tokens = 6000, max_calls_per_minute = None, max_pending = 256, num_threads = 2, max_errors = 100):
+        self.window_ms = window_ms
+        self.max_batch_jobs = max_batch_jobs
+        self.max_batch_tokens = max_batch_tokens
+        self.max_calls_per_minute = max_calls_per_minute
+        self.max_pending = max_pending
+        self.num_threads = num_threads
+        self.condition = threading.Condition()
+        
+        # partition -> deque of jobs (the first one may be in flight), partitions whose first job can join a batch, partitions in flight
+        self.lanes = {}
+        self.ready = deque()
+        self.in_flight = set()
+        self.num_pending = 0
+        
+        # Send times of recent batches, for the rate limit
+        self.rate_lock = threading.Lock()
+        self.call_times = deque()
+        
+        self.threads = []
+        self.stopping = False
+        self.counters = Counter()
+        
+        # The most recent failures as (agent name, repr of the exception), like the consolidation worker keeps
+        self.errors = deque(maxlen = max_errors)
+        self.num_errors = 0
+        
+        _LIVE_BATCH_SCHEDULERS.add(self)
+    
+    # Queue lost_messages from agent's partition to be summarized. Returns the MemoryBatchJob.
+    def submit(self, agent, partition, lost_messages):
+        job = MemoryBatchJob(agent, partition, lost_messages)
+        if not job.transcript:
+            job.done.set()
+            return job
+        
+        with self.condition:
+            if self.num_pending >= self.max_pending and not self.stopping:
+                self.counters["backpressure_waits"] += 1
+                self.condition.wait_for(lambda: self.num_pending < self.max_pending or self.stopping)
+            if self.stopping:
+                raise RuntimeError("MemoryBatchScheduler has been drained and no longer accepts jobs")
+            
+            lane = self.lanes.setdefault(partition, deque())
+            lane.append(job)
+            self.num_pending += 1
+            self.counters["jobs"] += 1
+            if len(lane) == 1 and partition not in self.in_flight:
+                self.ready.append(partition)
+            
+            self.start_threads()
+            self.condition.notify_all()
+        return job
+    
+    def start_threads(self):
+        while len(self.threads) < self.num_threads:
+            thread = threading.Thread(target = self.run, name = f"MemoryBatchScheduler-{len(self.threads)}", daemon = True)
+            self.threads.append(thread)
+            thread.start()
+    
+    # Thread loop - wait for a rate limit slot, let the window fill, send a batch, hand out its results
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.ready and not self.stopping:
+                    self.condition.wait()
+                if not self.ready:
+                    return
+            
+            self.acquire_call_slot()
+            with self.condition:
+                if self.ready:
+                    deadline = self.lanes[self.ready[0]][0].submitted + self.window_ms/1000
+                    while not self.stopping and len(self.ready) < self.max_batch_jobs and time.monotonic() < deadline:
+                        self.condition.wait(deadline - time.monotonic())
+                batch = self.take_batch()
+            if not batch:
+                self.release_call_slot()
+                continue
+            
+            try:
+                self.dispatch(batch)
+            except Exception as e:
+                # Memory maintenance must never take down the conversation - record and move on.
+                self.report_error(batch, e, f"Memory batch of {len(batch)} chat sections failed")
+            finally:
+                self.finish(batch)
+    
+    # Up to max_batch_jobs ready jobs with the oldest ready jobs LLM config, within max_batch_tokens - always at least one. Called with the condition held.
+    def take_batch(self):
+        batch = []
+        tokens = 0
+        for partition in list(self.ready):
+            job = self.lanes[partition][0]
+            if batch and (job.config_key != batch[0].config_key or tokens + job.tokens > self.max_batch_tokens):
+                continue
+            batch.append(job)
+            tokens += job.tokens
+            self.ready.remove(partition)
+            self.in_flight.add(partition)
+            if len(batch) >= self.max_batch_jobs:
+                break
+        return batch
+    
+    # Summarize a batch and pass each sections memories to its agent. A batch of one, or sections without a result, are summarized on their own -
+    # a batch of one on the rate limit slot taken for it, a section a batch left out on a slot of its own.
+    def dispatch(self, batch):
+        results = [None]*len(batch)
+        if len(batch) > 1:
+            self.count("batches")
+            self.count("batched_jobs", len(batch))
+            try:
+                with batch[0].agent.borrowed_memory_manager() as manager:
+                    results = manager.process_chat_sections(batch)
+            except Exception as e:
+                self.report_error(batch, e, f"Memory batch of {len(batch)} chat sections failed, summarizing them one by one")
+        
+        for job, memories in zip(batch, results):
+            if memories is None:
+                self.count("single_jobs")
+                if len(batch) > 1:
+                    self.acquire_call_slot()
+                self.run_for_job(job, job.agent.summarize_chat_section, job.lost_messages)
+            else:
+                job.partition.keep_function_outputs(job.digested)
+                self.run_for_job(job, job.agent.append_to_short_term_memory, memories)
+    
+    # Run func in the jobs partition - queued on its consolidation worker lane, so it stays in order with the agents other memory jobs, or here
+    def run_for_job(self, job, func, *args):
+        worker = job.agent.consolidation_worker
+        if worker is not None:
+            worker.submit(job.partition, job.agent.run_in_partition, job.partition, func, *args)
+        else:
+            job.agent.run_in_partition(job.partition, func, *args)
+    
+    # Release the batches partitions - their next jobs can go in the next batch
+    def finish(self, batch):
+        with self.condition:
+            for job in batch:
+                lane = self.lanes[job.partition]
+                lane.popleft()
+                self.in_flight.discard(job.partition)
+                self.num_pending -= 1
+                self.counters["completed"] += 1
+                if lane:
+                    self.ready.append(job.partition)
+                else:
+                    del self.lanes[job.partition]
+            self.condition.notify_all()
+        for job in batch:
+            job.done.set()
+    
+    def count(self, name, value = 1):
+        with self.condition:
+            self.counters[name] += value
+    
+    # Record a failure, and report it through the instrumentation of the agent whose manager ran the batch
+    def report_error(self, batch, error, message):
+        with self.condition:
+            self.errors.append((batch[0].agent.name, repr(error)))
+            self.num_errors += 1
+        instrumentation = batch[0].agent.instrumentation
+        instrumentation.count("memory_job_errors", agent = batch[0].agent.name)
+        instrumentation.debug(DEBUG_SUMMARY, lambda: f"{message}: {error!r}")
+    
+    # Block until another batch may be sent under max_calls_per_minute. The wait is worked out under rate_lock and slept off outside it,
+    # so release_call_slot and the other dispatch threads are never held up by a sleeping one.
+    def acquire_call_slot(self):
+        if self.max_calls_per_minute is None:
+            return
+        while True:
+            with self.rate_lock:
+                now = time.monotonic()
+                while self.call_times and now - self.call_times[0] >= 60:
+                    self.call_times.popleft()
+                if len(self.call_times) < self.max_calls_per_minute:
+                    self.call_times.append(now)
+                    return
+                wait = 60 - (now - self.call_times[0])
+            self.count("rate_limit_waits")
+            time.sleep(wait)
+    
+    # Give back a slot that found nothing to send
+    def release_call_slot(self):
+        if self.max_calls_per_minute is None:
+            return
+        with self.rate_lock:
+            if self.call_times:
+                self.call_times.pop()
+    
+    # Number of jobs waiting or in flight, for one partition or in total
+    def num_jobs(self, partition = None):
+        with self.condition:
+            if partition is None:
+                return self.num_pending
+            return len(self.lanes.get(partition, ()))
+    
+    # Block until every job submitted so far (for partition, or for all) has been handed to its agent. Returns False on timeout.
+    def flush(self, partition = None, timeout = None):
+        if threading.current_thread() in self.threads:
+            return False
+        with self.condition:
+            return self.condition.wait_for(lambda: (partition not in self.lanes) if partition is not None else not self.lanes, timeout)
+    
+    # Finish all queued jobs and stop the threads. Used at shutdown.
+    def drain(self, timeout = None):
+        finished = self.flush(timeout = timeout)
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout)
+        return finished
+    
+    def stats(self):
+        with self.condition:
+            return {
+                **{name: self.counters[name] for name in ("jobs", "completed", "batches", "batched_jobs", "single_jobs", "rate_limit_waits", "backpressure_waits")},
+                # Chat sections summarized per LLM call - every batch is one call, and every section summarized on its own another
+                "jobs_per_call": self.counters["completed"]/max(1, self.counters["batches"] + self.counters["single_jobs"]),
+                "pending": self.num_pending,
+                "errors": self.num_errors,
+            }
+
+
+# Every live batch scheduler. Registered after the consolidation worker hook, so at exit batches are sent first, then their memories consolidated.
+_LIVE_BATCH_SCHEDULERS = weakref.WeakSet()
+
+@atexit.register
+def _drain_live_batch_schedulers():
+    for scheduler in list(_LIVE_BATCH_SCHEDULERS):
+        scheduler.drain()
+
+
+# Everything a MEA remembers about one sender - STM, LTM shards and the LTM lookup index, backed by its own memory store in path.
+# Partitions are opened lazily by the MEA and closed again when they fall out of its LRU set of resident partitions.
+class MemoryPartition:
+    
+    # Files an agent kept before memory was partitioned by sender
+    LEGACY_FILES = ("memories.sqlite3", "memories.sqlite3-wal", "memories.sqlite3-shm", "short_term_memory.txt", "long_term_memory.txt", "long_term_memory")
+    
+    def __init__(self, agent, sender_name):
+        self.sender_name = sender_name
+        self.path = self.partition_path(agent, sender_name)
+        
+        # A new partition adopts memories the agent had from before partitioning, if any (the first sender to connect gets them).
+        # A directory from before partition names were hashed is taken over by the first sender with that name to connect.
+        if not os.path.exists(self.path):
+            unhashed_path = self.unhashed_partition_path(agent, sender_name)
+            if os.path.isdir(unhashed_path):
+                os.replace(unhashed_path, self.path)
+            else:
+                os.makedirs(self.path)
+            for file_name in self.LEGACY_FILES:
+                legacy_path = os.path.join(agent.memories_path, file_name)
+                if os.path.exists(legacy_path):
+                    os.replace(legacy_path, os.path.join(self.path, file_name))
+        
+        # Open the memory store, bringing in memories from the old text files the first time
+        self.store = SQLiteMemoryStore(
+            os.path.join(self.path, "memories.sqlite3"),
+            instrumentation = agent.instrumentation,
+            compact_every = agent.DEFAULT_OPERATION_LOG_COMPACT_EVERY,
+        )
+        migrate_text_memories(self.path, self.store)
+        
+        # Memories that left STM but never made it into LTM (crash during consolidation) go back to STM, oldest first, to be consolidated again.
+        # Shards finished before the crash already dropped the memories they took in, so those are not sent to the MMA twice.
+        stranded = self.store.read("consolidating")
+        if stranded:
+            self.store.move([r.id for r in stranded], "stm")
+            agent.instrumentation.count("memories_recovered", len(stranded))
+        
+        # STM is held in memory from here on and written behind to the store
+        self.short_term_memory = ShortTermMemoryCache(
+            self.store,
+            flush_policy = agent.DEFAULT_STM_FLUSH_POLICY,
+            flush_interval_ms = agent.DEFAULT_STM_FLUSH_INTERVAL_MS,
+        )
+        
+        self.ltm_shards = LongTermMemoryShards(
+            self.store,
+            max_entries = agent.DEFAULT_LTM_SHARD_MAX_ENTRIES,
+            routing_threshold = agent.DEFAULT_LTM_SHARD_ROUTING_THRESHOLD,
+            count_tokens = lambda text: count_tokens(text, agent.llm_model),
+        )
+        
+        # LTM from before the hot LTM was capped is brought within the cap straight away
+        self.ltm_shards.archive_coldest(agent.DEFAULT_LTM_HOT_MAX_TOKENS)
+        
+        # Local ranked index over LTM entries, so lookups only send the relevant part of LTM.
+        self.ltm_index = LongTermMemoryIndex()
+        self.ltm_index.sync(self.ltm_shards.entries())
+        
+        # New memories dropped as repeats since the partition was opened
+        self.suppressed_memories = 0
+        
+        # Function results kept for read_function_output, oldest dropped first
+        self.function_output_max_entries = agent.DEFAULT_FUNCTION_OUTPUT_MAX_ENTRIES
+    
+    # Directory for a senders memories - the name made filesystem safe, plus a hash of the exact name, so senders whose names only
+    # differ in characters that get replaced (e.g. "Andy Smith" and "Andy_Smith") never share a memory store
+    @classmethod
+    def partition_path(cls, agent, sender_name):
+        return f"{cls.unhashed_partition_path(agent, sender_name)}-{hashlib.sha1(sender_name.encode()).hexdigest()[:8]}"
+    
+    # Directory partitions used before their names were hashed
+    @staticmethod
+    def unhashed_partition_path(agent, sender_name):
+        return os.path.join(agent.memories_path, re.sub(r"[^A-Za-z0-9_.-]", "_", sender_name))
+    
+    # Whether there is anything on disk for this partition yet - its own directory, or an unhashed directory or legacy files it would adopt
+    @classmethod
+    def exists(cls, agent, sender_name):
+        if not os.path.isdir(agent.memories_path):
+            return False
+        if os.path.exists(cls.partition_path(agent, sender_name)) or os.path.isdir(cls.unhashed_partition_path(agent, sender_name)):
+            return True
+        return any(os.path.exists(os.path.join(agent.memories_path, file_name)) for file_name in cls.LEGACY_FILES)
+    
+    # Keep function results that were cut short in a summarize transcript, under their digest - see render_transcript. Only the
+    # newest function_output_max_entries are kept.
+    def keep_function_outputs(self, digested):
+        if not digested:
+            return
+        with self.store.atomic():
+            for digest, output in digested.items():
+                if not self.store.find("function_output", digest):
+                    self.store.append("function_output", [output], source = digest)
+            if self.function_output_max_entries is not None:
+                excess = self.store.count("function_output") - self.function_output_max_entries
+                if excess > 0:
+                    self.store.delete(self.store.oldest_ids("function_output", excess))
+    
+    # Write everything out and release the store
+    def close(self):
+        self.short_term_memory.close()
+        self.store.close()
+
+
 # Memory Enabled Agent(MEA)/Memory front-end - this is the object instanced in main
 class MemoryEnabledAgent(AssistantAgent):
     
@@ -14,26 +1981,119 @@ class MemoryEnabledAgent(AssistantAgent):
     Be sure to modulate your discussion by what you remember about {sender}.
     If something is missing that you should know, try checking your memory using lookup_from_long_term_memory and pass in a hint describing what you are trying to remember.
     If you are asked what can you remember, it would be good to call lookup_from_long_term_memory.
+    If a memory mentions the digest of a function result and you need its details, call read_function_output with that digest.
     """
     
     # Other portion of MEA system prompt - this should be modified for the task at hand for the MEA
     DEFAULT_SYSTEM_MESSAGE = """   """
     
     #--------- Dynamic Memory Settings -----------
-    # Consult documentation before adjusting from defaults - Bad values can cause infinite looping/AI calls/$$
+    # Consult documentation before adjusting from defaults - Bad values can cause extra AI calls/$$. Trimming and consolidation loops are guarded against, see CompressionController.
     # Max number of short term memories before initiating compression to long
     DEFAULT_SHORT_TERM_MEMORY_LIMIT = 10
     
     # Proportion to cut short term memory off (0.9 drops 9 out of 10 memories after exceeding STM limit, 0.1 drops 1 out of 10 memories after exceeding STM limit)
     DEFAULT_COMPRESSION_RATIO_STM = 0.8
     
-    # Max convo length before the end starts falling off, in number of messages. User and AI both count, so minimum is 2.
-    DEFAULT_MAX_CONVO_LENGTH = 10
+    # Token cap for STM, which is pinned at the top of every chat context. Past it, the oldest STM memories move straight to the archive
+    # (searched by lookups), even while consolidation is backed off after failures. None for no cap.
+    DEFAULT_STM_MAX_TOKENS = 512
+    
+    # New memories that repeat something already in STM or LTM are dropped before they reach STM. A memory is a repeat if it has the
+    # same words as one already kept, or if their word shingle similarity (0 to 1) is at or above this. None keeps every memory.
+    DEFAULT_STM_DEDUP_SIMILARITY = 0.8
+    
+    # LTM entries, ranked by the lookup index, each new memory is compared with
+    DEFAULT_STM_DEDUP_LTM_CANDIDATES = 5
+    
+    # Token budget for the chat context (STM header + conversation). Trimming starts above the high watermark and removes
+    # exactly enough of the oldest messages to get back under the low watermark. Watermarks are proportions of the budget.
+    DEFAULT_MAX_CONTEXT_TOKENS = 2048
+    DEFAULT_CONTEXT_HIGH_WATERMARK = 0.9
+    DEFAULT_CONTEXT_LOW_WATERMARK = 0.5
     
-    # Proportion to cut chat off (0.9 drops 9 out of 10 chats after exceeding limit, 0.1 drops 1 out of 10 chats after exceeding limit)
+    # Optional cap on convo length, in number of messages, on top of the token budget. User and AI both count, so minimum is 2. None for tokens only.
+    DEFAULT_MAX_CONVO_LENGTH = None
+    
+    # Proportion to cut chat off when DEFAULT_MAX_CONVO_LENGTH is exceeded (0.9 drops 9 out of 10 chats after exceeding limit, 0.1 drops 1 out of 10 chats after exceeding limit)
     DEFAULT_COMPRESSION_RATIO_CHAT = 0.8
     
-    def __init__(self, name, gpt_config):
+    # Adjust both compression ratios at runtime from measured memory upkeep cost and turn time, instead of keeping them fixed. See CompressionController.
+    DEFAULT_ADAPTIVE_COMPRESSION = False
+    
+    # What the adaptive ratios aim for: LLM tokens per turn (reply context, summarizing and consolidating), and turn time in milliseconds. None leaves a target out.
+    DEFAULT_COMPRESSION_TARGET_TOKENS_PER_TURN = 1500
+    DEFAULT_COMPRESSION_TARGET_TURN_MS = None
+    
+    # Range the adaptive ratios stay in, and turns between adjustments
+    DEFAULT_COMPRESSION_RATIO_BOUNDS = (0.2, 0.95)
+    DEFAULT_COMPRESSION_ADJUST_EVERY = 20
+    
+    # When the in-memory STM is written to disk - 'turn', 'interval' or 'shutdown'. See ShortTermMemoryCache.
+    DEFAULT_STM_FLUSH_POLICY = "turn"
+    
+    # Minimum time between STM writes when using the 'interval' flush policy, in milliseconds.
+    DEFAULT_STM_FLUSH_INTERVAL_MS = 1000
+    
+    # Every memory change is logged in the memory store - the log is compacted once it holds this many operations. None to keep it all.
+    DEFAULT_OPERATION_LOG_COMPACT_EVERY = 1000
+    
+    # How the MMA runs a memory operation. 'direct' makes one completion and runs the function call in it, keeping no chat history.
+    # 'chat' holds an AutoGen chat with a hidden user proxy that runs the function call - two LLM calls, ended by TERMINATE.
+    DEFAULT_MEMORY_MANAGER_MODE = "direct"
+    
+    # Run chat summarization and STM->LTM consolidation on a background worker instead of before the reply is generated.
+    DEFAULT_BACKGROUND_MEMORY = True
+    
+    # Threads for the shared consolidation worker. Jobs for a single agent always run one at a time, in order.
+    DEFAULT_CONSOLIDATION_THREADS = 2
+    
+    # Memory jobs (summarize, consolidate, lookup) a_receive and friends run at once on an event loop when background memory is off.
+    # Jobs for the same sender always run one at a time.
+    DEFAULT_ASYNC_MEMORY_CONCURRENCY = 4
+    
+    # Function results longer than this many tokens are cut short in the transcript the memory manager summarizes. The full result is
+    # kept in the memory store, see read_function_output. None sends them whole.
+    DEFAULT_SUMMARY_FUNCTION_OUTPUT_TOKENS = 200
+    
+    # Full function results kept per sender for read_function_output - the oldest are dropped past this many. None keeps them all.
+    DEFAULT_FUNCTION_OUTPUT_MAX_ENTRIES = 200
+    
+    # Number of LTM entries, ranked by the local index, sent to the memory manager for a lookup.
+    DEFAULT_LOOKUP_TOP_K = 8
+    
+    # Index match confidence (0 to 1) at or above which a lookup is answered from the matching entries directly, with no LLM call.
+    DEFAULT_LOOKUP_DIRECT_CONFIDENCE = 0.8
+    
+    # LTM is split into topic shards so consolidation only rewrites the shards new memories belong to. A shard larger than this is split in two.
+    DEFAULT_LTM_SHARD_MAX_ENTRIES = 20
+    
+    # TF-IDF cosine similarity (0 to 1) a new memory needs with a shard to be routed to it - otherwise it goes to a new shard.
+    DEFAULT_LTM_SHARD_ROUTING_THRESHOLD = 0.15
+    
+    # Token cap for the hot LTM that consolidation and lookups work with. Past it, the least recently used entries move to the archive,
+    # which lookups search only when the hot LTM has nothing on the hint. None for no cap.
+    DEFAULT_LTM_HOT_MAX_TOKENS = 8000
+    
+    # LTM entries related to each incoming message are found in the local lookup index and shown in the STM header before the reply,
+    # saving the lookup_from_long_term_memory round trip. At most this many tokens of them - 0 turns prefetching off.
+    DEFAULT_LTM_PREFETCH_TOKENS = 256
+    
+    # Most LTM entries prefetched per message, and the index match confidence (0 to 1) an entry needs to be prefetched.
+    DEFAULT_LTM_PREFETCH_TOP_K = 4
+    DEFAULT_LTM_PREFETCH_MIN_CONFIDENCE = 0.5
+    
+    # Lookup results are cached until LTM changes, for at most this many seconds, in at most this many bytes.
+    DEFAULT_LOOKUP_CACHE_TTL_SECONDS = 600
+    DEFAULT_LOOKUP_CACHE_MAX_BYTES = 1 << 20
+    
+    # Debug output when no instrumentation is passed in - 0 for none, DEBUG_SUMMARY for one line per event, DEBUG_PAYLOADS to also dump chat contents and MMA chats
+    DEFAULT_DEBUG_VERBOSITY = 0
+    
+    # Memory is kept separately for every sender the MEA talks to. This many sender partitions stay loaded, least recently used ones are closed.
+    DEFAULT_MAX_RESIDENT_PARTITIONS = 64
+    
+    def __init__(self, name, gpt_config, instrumentation = None, memory_manager_pool = None, memory_batch_scheduler = None):
         # Grab GPT params for other agents
         self.gpt_config = gpt_config
         self.llm_config = gpt_config['config_list']
@@ -64,6 +2124,20 @@ class MemoryEnabledAgent(AssistantAgent):
                             "required": ["hint"],
                         },
                     },
+                    {
+                        "name": "read_function_output",
+                        "description": "Reads back the full text of a function result that was cut short in your memories. Use this when a memory mentions a digest and you need the details it left out.",
+                        "parameters": {
+                            "type": "object",
+                            "properties": {
+                                "digest": {
+                                    "type": "string",
+                                    "description": "The digest given in the memory, in place of the rest of the function result.",
+                                },
+                            },
+                            "required": ["digest"],
+                        },
+                    },
                     
                 ],
             },
@@ -71,24 +2145,44 @@ class MemoryEnabledAgent(AssistantAgent):
             system_message = self.DEFAULT_SYSTEM_MESSAGE + self.DEFAULT_MEM_AGENT_MESSAGE 
         )
         
-        # Path to directory containing specific MEA instance memories
+        # Spans, counters and debug output. Defaults to no-op hooks that only print debug output up to DEFAULT_DEBUG_VERBOSITY.
+        self.instrumentation = instrumentation if instrumentation is not None else MemoryInstrumentation(verbosity = self.DEFAULT_DEBUG_VERBOSITY)
+        instrument_oai_replies(self)
+        
+        # Path to directory containing specific MEA instance memories - one sub directory per sender
         self.memories_path = os.path.join(MEMORY_DIRECTORY, self.name)
         
-        # Paths to short term and long term memory files
-        self.short_term_memory_path = os.path.join(self.memories_path,"short_term_memory.txt")
-        self.long_term_memory_path = os.path.join(self.memories_path,"long_term_memory.txt")
+        # Who MEA is conversing with, and the memory partition in use, for the current thread/task. Several senders can be served at once.
+        self.current_sender = contextvars.ContextVar(f"{self.name}_current_sender", default = None)
+        self.current_partition_var = contextvars.ContextVar(f"{self.name}_current_partition", default = None)
+        self.last_sender = None
         
         # Initialize memories
         self.memories = self.initialize_memories()
         
-        # Initialize Memory Manager Agent (MMA) - tie it into MEA object
-        self.memory_manager = self.initialize_memory_manager()
+        # Memory Manager Agent (MMA) - created on first use, or borrowed from memory_manager_pool for each memory operation if one is given
+        self.memory_manager_pool = memory_manager_pool
+        self._memory_manager = None
+        
+        # Trimmed chat sections are summarized along with other agents' in shared LLM calls, if a MemoryBatchScheduler is given
+        self.memory_batch_scheduler = memory_batch_scheduler
+        
+        # Chat and STM compression ratios, and the guards against trimming and consolidation loops
+        self.compression_controller = CompressionController(self)
+        
+        # Worker that runs memory maintenance off the reply path
+        self.consolidation_worker = get_consolidation_worker() if self.DEFAULT_BACKGROUND_MEMORY else None
+        
+        # Async memory jobs: a limit across senders, and a lock per memory partition
+        self.memory_job_semaphore = asyncio.Semaphore(self.DEFAULT_ASYNC_MEMORY_CONCURRENCY)
+        self.async_partition_locks = weakref.WeakKeyDictionary()
         
         # Functions that must be callable by MEA when conversing with UserProxyAgent
-        self.functions_for_map = [self.lookup_from_long_term_memory]
+        self.functions_for_map = [self.lookup_from_long_term_memory, self.read_function_output]
+        
         
-        # Initialize placeholder for remembering who MEA is conversing with - only initialized once per chat.
-        self.sender_agent = None
+        # Chat context per sender is a ChatWindow, which counts each messages tokens once, as it arrives
+        self._oai_messages = defaultdict(self.new_chat_window)
         
     # Mostly Copy/Paste from AutoGen standard AssistantAgent. Need to override receive in such a way that the chat length on the agents side stays small/under max/follows memory logic
     def receive(
@@ -121,12 +2215,80 @@ class MemoryEnabledAgent(AssistantAgent):
             ValueError: if the message can't be converted into a valid ChatCompletion message.
         """
         
-        # Read short term memory file
-        self.memories = self.read_short_term_memory()
+        # Whole turn, including the reply
+        turn_start = time.perf_counter()
+        with self.instrumentation.span("receive", agent = self.name), self.holding_partition(sender.name):
+            # Remember who MEA is conversing with - memory is read and written in this senders partition for the rest of the turn
+            self.sender_agent = sender
         
+            # Default AutoGen function, then fit the chat context to its limits
+            lost_messages = self.update_chat_context(message, sender, silent)
+            
+            # send trimmed messages to memory manager to process - in the background if enabled, so the reply isn't held up
+            if lost_messages:
+                self.submit_chat_section(lost_messages)
+            
+            # End of turn for the STM cache - write behind according to flush policy. A sender with no memories yet has nothing to write.
+            if sender.name in self.memory_partitions:
+                self.short_term_memory.end_turn()
+
+            # Default AutoGen Logic
+            if request_reply is False or request_reply is None and self.reply_at_receive[sender] is False:
+                return   
+            reply = self.generate_reply(messages=self.chat_messages[sender], sender=sender)
+            self.compression_controller.record_turn(time.perf_counter() - turn_start, self.context_tokens(sender))
+            if reply is not None:
+                self.send(reply, sender, silent=silent)
+    
+    # Async receive with the same memory logic. Disk access, memory jobs and the LLM call run in threads, so the event loop is never
+    # blocked, and each task keeps its own current sender - one MEA can hold many conversations on one loop.
+    async def a_receive(
+        self,
+        message: Union[Dict, str],
+        sender: Agent,
+        request_reply: Optional[bool] = None,
+        silent: Optional[bool] = False,
+    ):
+        turn_start = time.perf_counter()
+        async with self.a_holding_partition(sender.name):
+            with self.instrumentation.span("receive", agent = self.name):
+                self.sender_agent = sender
+                
+                # The sender runs the function calls in our replies - on its async path, in a thread
+                if isinstance(sender, ConversableAgent):
+                    thread_function_calls(sender)
+                
+                # A senders memory is opened from disk on first use, if there is any. Whether there is any is checked in a thread too.
+                if sender.name not in self.memory_partitions:
+                    if sender.name not in self.partitions_on_disk:
+                        await asyncio.to_thread(self.has_memories, sender)
+                    if self.partitions_on_disk.get(sender.name):
+                        await asyncio.to_thread(self.memory_partition, sender.name)
+                
+                lost_messages = self.update_chat_context(message, sender, silent)
+                if lost_messages:
+                    await self.a_submit_chat_section(lost_messages)
+                
+                if sender.name in self.memory_partitions and self.short_term_memory.dirty:
+                    await asyncio.to_thread(self.short_term_memory.end_turn)
+                
+                # Default AutoGen Logic
+                if request_reply is False or request_reply is None and self.reply_at_receive[sender] is False:
+                    return
+                reply = await self.a_generate_reply(sender=sender)
+                self.compression_controller.record_turn(time.perf_counter() - turn_start, self.context_tokens(sender))
+                if reply is not None:
+                    await self.a_send(reply, sender, silent=silent)
+    
+    # Receive-side memory logic shared by receive and a_receive: add the message, put STM at the top of the context and trim the context
+    # back under its limits. Returns the trimmed messages, oldest first. Works from memory only - no disk or LLM access.
+    def update_chat_context(self, message, sender, silent):
+        # Read short term memory (from the in-memory cache, not disk). Until a sender has memories, nothing is opened or created for them.
+        self.memories = self.read_short_term_memory() if self.has_memories(sender) else ""
+    
         # Default AutoGen function
         self._process_received_message(message, sender, silent)
-               
+           
         # If there is more than the initial message
         if len(self.chat_messages[sender]) > 1:
             # Construct the STM message to be placed at top of context
@@ -134,151 +2296,454 @@ class MemoryEnabledAgent(AssistantAgent):
             m0['content']="Things you remember about {sender}: {short_term_memories}|".format(short_term_memories = self.memories, sender = self.sender_agent.name)
             m0['role']='assistant'
             
-            # Overwrite top of context with STM
-            self.chat_messages[sender][0] = m0
+            # Older memories related to the new message, so the MEA rarely needs to call lookup_from_long_term_memory
+            prefetched = self.prefetch_long_term_memories(sender, self.chat_messages[sender][-1])
+            if prefetched:
+                m0['content'] += " Older memories that may be relevant: {older_memories}|".format(older_memories = "|".join(prefetched))
         
+            # Overwrite top of context with STM - unless STM hasn't changed, then keep the header and its token count
+            self.chat_messages[sender].pin(m0)
+    
         # If there is only the initial message - only at chat initialization
         else: 
-            # set sender_agent to sender, and format MEA system prompt to senders name
-            self.sender_agent = sender # safe to set here
+            # format MEA system prompt to senders name
             self.system_message.format(sender=self.sender_agent.name)
-            
-        
-        # Debugging callouts for monitoring chat progression/dynamics
-        print("DEBUG: NumChatMessages: " + str(len(self.chat_messages[sender])) + " vs Limit:" + str(self.DEFAULT_MAX_CONVO_LENGTH))
-        print("DEBUG: ChatMessages:")
-        print(self.chat_messages[sender])
-        print("END DEBUG")
         
-        # If max length is hit, use compression ratio to trim window and then pass history to memory manager
+    
+        # Debugging callouts for monitoring chat progression/dynamics - only built when shown
+        self.instrumentation.debug(DEBUG_SUMMARY, lambda: f"NumChatMessages: {len(self.chat_messages[sender])} ContextTokens: {self.context_tokens(sender)} vs Limit: {self.DEFAULT_MAX_CONTEXT_TOKENS}")
+        self.instrumentation.debug(DEBUG_PAYLOADS, lambda: f"ChatMessages:\n{self.chat_messages[sender]}")
+    
+        # If max length is hit, trim window back under the limits and then pass history to memory manager
         # Remove the oldest message, but not the first! First message is dynamic short term memory
         if self.chat_too_long():
-            # index 0 is short term memory, index 1 is start of conversation, and where to do FILO
-            # use compression ratio to determine trim number
-            trim_num = int(len(self.chat_messages[sender])*self.DEFAULT_COMPRESSION_RATIO_CHAT)
-            lost_messages = []
-            
-            # pop corresponding messages out of chat history
-            for i in range(trim_num-1):
-                lost_messages.append(self.chat_messages[sender].pop(1))
-            
-            # send messages to memory manager to process
-            self.memory_manager.process_chat_section(lost_messages)
-            
+            with self.instrumentation.span("trim", agent = self.name):
+                # index 0 is short term memory, index 1 is start of conversation, and where to do FILO - cut the oldest messages out of chat history
+                lost_messages = self.chat_messages[sender].evict(self.chat_trim_count())
+        
             # Debugging callouts for monitoring chat message trimming
-            print(f"DEBUG: Messages trimmed from chat:\n{lost_messages}")
-
-        # Default AutoGen Logic
-        if request_reply is False or request_reply is None and self.reply_at_receive[sender] is False:
-            return   
-        reply = self.generate_reply(messages=self.chat_messages[sender], sender=sender)
-        if reply is not None:
-            self.send(reply, sender, silent=silent)
+            self.instrumentation.debug(DEBUG_SUMMARY, lambda: f"Trimmed {len(lost_messages)} messages from chat")
+            self.instrumentation.debug(DEBUG_PAYLOADS, lambda: f"Messages trimmed from chat:\n{lost_messages}")
+            return lost_messages
+        return []
     
-    # Initilize memory structure and MEA memories.
-    def initialize_memories(self):
-        # Does a memory directory exist? If not, make one
-        if not os.path.exists(MEMORY_DIRECTORY):
-            os.makedirs(MEMORY_DIRECTORY)
+    # LTM entries related to message for the STM header, best first, within DEFAULT_LTM_PREFETCH_TOKENS. Only the local index of a loaded
+    # partition is searched - no disk or LLM access on the reply path.
+    def prefetch_long_term_memories(self, sender, message):
+        if not self.DEFAULT_LTM_PREFETCH_TOKENS or message.get("role") == "function" or not message.get("content"):
+            return []
+        partition = self.memory_partitions.get(sender.name)
+        if partition is None or not len(partition.ltm_index):
+            return []
         
-        # Does this specific agents memory exist? 
-        if os.path.exists(self.memories_path):
-            return self.read_short_term_memory()
+        with self.instrumentation.span("prefetch", agent = self.name):
+            prefetched = []
+            budget = self.DEFAULT_LTM_PREFETCH_TOKENS
+            for score, confidence, text in partition.ltm_index.search(message["content"], k = self.DEFAULT_LTM_PREFETCH_TOP_K):
+                tokens = count_tokens(text, self.llm_model)
+                if confidence >= self.DEFAULT_LTM_PREFETCH_MIN_CONFIDENCE and tokens <= budget:
+                    prefetched.append(text)
+                    budget -= tokens
         
-        # If not, initialize the memory folder and files
+        if prefetched:
+            partition.ltm_shards.touch(prefetched)
+            self.instrumentation.count("ltm_prefetch_hits", agent = self.name)
         else:
-            os.makedirs(self.memories_path)
-            with open(self.long_term_memory_path, 'w') as f:
-                pass
-                
-            with open(self.short_term_memory_path, 'w') as f:
-                pass
-                
-            return None
+            self.instrumentation.count("ltm_prefetch_misses", agent = self.name)
+        self.instrumentation.debug(DEBUG_PAYLOADS, lambda: f"Prefetched from LTM: {prefetched}")
+        return prefetched
+    
+    # Initilize memory structure. Memories themselves are loaded per sender, on first use - the agents memory folder is made along with its first partition.
+    def initialize_memories(self):
+        # Resident sender partitions, least recently used first
+        self.memory_partitions = OrderedDict()
+        self.partitions_lock = threading.RLock()
+        
+        # sender name -> whether that sender has memories on disk, for senders checked or evicted so far
+        self.partitions_on_disk = {}
+        
+        # sender name -> turns and memory jobs using that senders partition right now. Held partitions are never evicted.
+        self.partition_holders = Counter()
+        self.holders_lock = threading.Lock()
+        return None
+    
+    # The sender MEA is conversing with in this thread/task. Falls back to the last sender seen anywhere.
+    @property
+    def sender_agent(self):
+        sender = self.current_sender.get()
+        return sender if sender is not None else self.last_sender
+    
+    @sender_agent.setter
+    def sender_agent(self, sender):
+        self.current_sender.set(sender)
+        if sender is not None:
+            self.last_sender = sender
+    
+    # Memory partition for a sender name, loading it if needed and closing least recently used partitions beyond the resident limit.
+    def memory_partition(self, sender_name):
+        with self.partitions_lock:
+            partition = self.memory_partitions.get(sender_name)
+            if partition is not None:
+                self.memory_partitions.move_to_end(sender_name)
+                return partition
+            
+            partition = MemoryPartition(self, sender_name)
+            self.memory_partitions[sender_name] = partition
+            # A new partition may have adopted the agents memories from before partitioning - other senders are checked again
+            self.partitions_on_disk = {sender_name: True}
+            self.evict_memory_partitions()
+            return partition
+    
+    # Close cold partitions until within DEFAULT_MAX_RESIDENT_PARTITIONS. Partitions a turn or memory job holds, partitions with queued
+    # memory jobs, and the most recently used one, are kept - held partitions are evicted by a later call, once released.
+    def evict_memory_partitions(self):
+        with self.partitions_lock, self.holders_lock:
+            excess = len(self.memory_partitions) - self.DEFAULT_MAX_RESIDENT_PARTITIONS
+            for sender_name in list(self.memory_partitions)[:-1]:
+                if excess <= 0:
+                    break
+                partition = self.memory_partitions[sender_name]
+                if self.partition_holders[sender_name]:
+                    continue
+                if self.consolidation_worker is not None and self.consolidation_worker.num_pending(partition):
+                    continue
+                if self.memory_batch_scheduler is not None and self.memory_batch_scheduler.num_jobs(partition):
+                    continue
+                lock = self.async_partition_locks.get(partition)
+                if lock is not None and lock.locked():
+                    continue
+                del self.memory_partitions[sender_name]
+                partition.close()
+                self.partitions_on_disk[sender_name] = True
+                excess -= 1
+    
+    # Keep a senders partition resident for the duration - a turn with that sender, or a memory job in their partition. Partitions
+    # kept past DEFAULT_MAX_RESIDENT_PARTITIONS because they were held are evicted on release.
+    @contextlib.contextmanager
+    def holding_partition(self, sender_name, evict = True):
+        with self.holders_lock:
+            self.partition_holders[sender_name] += 1
+        try:
+            yield
+        finally:
+            with self.holders_lock:
+                self.partition_holders[sender_name] -= 1
+                if not self.partition_holders[sender_name]:
+                    del self.partition_holders[sender_name]
+            if evict and len(self.memory_partitions) > self.DEFAULT_MAX_RESIDENT_PARTITIONS:
+                self.evict_memory_partitions()
+    
+    # Async holding_partition - closing evicted partitions writes to disk, so it happens in a thread
+    @contextlib.asynccontextmanager
+    async def a_holding_partition(self, sender_name):
+        with self.holding_partition(sender_name, evict = False):
+            yield
+        if len(self.memory_partitions) > self.DEFAULT_MAX_RESIDENT_PARTITIONS:
+            await asyncio.to_thread(self.evict_memory_partitions)
+    
+    # Whether sender has a memory partition loaded or on disk. The disk is only checked the first time for each sender.
+    def has_memories(self, sender):
+        if sender.name in self.memory_partitions:
+            return True
+        on_disk = self.partitions_on_disk.get(sender.name)
+        if on_disk is None:
+            on_disk = self.partitions_on_disk[sender.name] = MemoryPartition.exists(self, sender.name)
+        return on_disk
+    
+    # Memory partition in use - the one a memory job is running for, otherwise the current senders.
+    def current_partition(self):
+        partition = self.current_partition_var.get()
+        if partition is not None:
+            return partition
+        if self.sender_agent is None:
+            raise RuntimeError(f"{self.name} has no conversation yet, so there is no sender memory to use")
+        return self.memory_partition(self.sender_agent.name)
+    
+    # Awaitable current_partition. Opening a senders partition the first time touches the disk, so it is resolved in a thread,
+    # never on the event loop.
+    async def a_current_partition(self):
+        return self.current_partition_var.get() or await asyncio.to_thread(self.current_partition)
+    
+    # STM cache and memory store of the current partition
+    @property
+    def short_term_memory(self):
+        return self.current_partition().short_term_memory
+    
+    @property
+    def memory_store(self):
+        return self.current_partition().store
                 
     # Initialize the MEA's memory manager agent, pass in MEA object.
     def initialize_memory_manager(self):
         return MemoryEnabledAgent_Manager(parent_agent = self)
     
+    # This MEAs own memory manager, created the first time it is needed
+    @property
+    def memory_manager(self):
+        if self._memory_manager is None:
+            with self.partitions_lock:
+                if self._memory_manager is None:
+                    self._memory_manager = self.initialize_memory_manager()
+        return self._memory_manager
+    
+    # Memory manager to use for one memory operation - borrowed from the shared pool if there is one, otherwise this MEAs own
+    @contextlib.contextmanager
+    def borrowed_memory_manager(self):
+        if self.memory_manager_pool is None:
+            yield self.memory_manager
+        else:
+            with self.memory_manager_pool.borrow(self) as manager:
+                yield manager
+    
+    # Memory job for messages trimmed from the chat - the MMA summarizes them into STM
+    def summarize_chat_section(self, lost_messages):
+        with self.borrowed_memory_manager() as manager:
+            return manager.process_chat_section(lost_messages)
+    
+    # Trimmed messages go to the memory batch scheduler if there is one, otherwise they are summarized as a memory job. Without
+    # background memory, the summary is in STM when this returns either way.
+    def submit_chat_section(self, lost_messages, partition = None):
+        partition = partition or self.current_partition()
+        if self.memory_batch_scheduler is None:
+            return self.run_memory_job(self.summarize_chat_section, lost_messages, partition = partition)
+        job = self.memory_batch_scheduler.submit(self, partition, lost_messages)
+        if self.consolidation_worker is None:
+            job.wait()
+        return None
+    
+    async def a_submit_chat_section(self, lost_messages):
+        partition = await self.a_current_partition()
+        if self.memory_batch_scheduler is None:
+            return await self.a_run_memory_job(self.summarize_chat_section, lost_messages, partition = partition)
+        return await asyncio.to_thread(self.submit_chat_section, lost_messages, partition)
+    
+    # Run a memory maintenance job for the current partition, or the one given - queued on that partitions lane of the consolidation
+    # worker, or inline if background memory is off. Returns the job result when run inline, None when queued.
+    def run_memory_job(self, func, *args, partition = None, **kwargs):
+        partition = partition or self.current_partition()
+        if self.consolidation_worker is None:
+            return self.run_in_partition(partition, func, *args, **kwargs)
+        self.consolidation_worker.submit(partition, self.run_in_partition, partition, func, *args, **kwargs)
+        return None
+    
+    # Awaitable run_memory_job. Queued on the consolidation worker as usual if background memory is on, otherwise run in a thread -
+    # at most DEFAULT_ASYNC_MEMORY_CONCURRENCY at once, and one at a time per partition.
+    async def a_run_memory_job(self, func, *args, partition = None, **kwargs):
+        partition = partition or await self.a_current_partition()
+        if self.consolidation_worker is not None:
+            self.consolidation_worker.submit(partition, self.run_in_partition, partition, func, *args, **kwargs)
+            return None
+        lock = self.async_partition_locks.setdefault(partition, asyncio.Lock())
+        async with lock, self.memory_job_semaphore:
+            return await asyncio.to_thread(self.run_in_partition, partition, func, *args, **kwargs)
+    
+    # Run func with partition as the current partition, so memory reads/writes (including MMA function calls) land in it.
+    # The end of a job is an end of turn for the STM cache - what a background job wrote doesn't wait for the senders next turn.
+    def run_in_partition(self, partition, func, *args, **kwargs):
+        token = self.current_partition_var.set(partition)
+        try:
+            with self.holding_partition(partition.sender_name):
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    partition.short_term_memory.end_turn()
+        finally:
+            self.current_partition_var.reset(token)
+    
     # Check if chat is exceeding limits - return True if true, False otherwise
+    # Function calls never make it into the chat window, so only the token budget and message cap are checked.
     def chat_too_long(self):
-        # Remove function calls when they are seen, but NOT 'role' = function messages. It looks like that is the response/return value. But 'function_call' is purely the call and shouldn't really count or exist in chat.
-        all_chats = self.chat_messages[self.sender_agent]
-        filtered_chats = [c for c in all_chats if 'function_call' not in c]
-        self.chat_messages[self.sender_agent] = filtered_chats
+        # Token logic.
+        if self.context_tokens() > self.DEFAULT_MAX_CONTEXT_TOKENS*self.DEFAULT_CONTEXT_HIGH_WATERMARK:
+            return True
         
-        # Length logic.
-        if len(self.chat_messages[self.sender_agent]) > self.DEFAULT_MAX_CONVO_LENGTH:
+        # Optional length logic.
+        if self.DEFAULT_MAX_CONVO_LENGTH is not None and len(self.chat_messages[self.sender_agent]) > self.DEFAULT_MAX_CONVO_LENGTH:
             return True
         else:
             return False
     
+    # Number of messages to trim from index 1 (oldest conversation message) to get back within limits. The newest message always stays.
+    def chat_trim_count(self):
+        window = self.chat_messages[self.sender_agent]
+        trim_num = 0
+        
+        # Message cap - use compression ratio to determine trim number
+        if self.DEFAULT_MAX_CONVO_LENGTH is not None and len(window) > self.DEFAULT_MAX_CONVO_LENGTH:
+            trim_num = self.compression_controller.chat_trim_count(len(window))
+        
+        # Token budget - drop the oldest messages until just enough tokens are gone to be under the low watermark
+        excess = window.total_tokens - int(self.DEFAULT_MAX_CONTEXT_TOKENS*self.compression_controller.chat_low_watermark())
+        token_trim_num = 0
+        tokens = iter(window.tokens)
+        next(tokens, None)
+        while excess > 0 and 1 + token_trim_num < len(window) - 1:
+            excess -= next(tokens)
+            token_trim_num += 1
+        
+        return max(0, min(max(trim_num, token_trim_num), len(window) - 2))
+    
+    # Empty chat context for a new conversation
+    def new_chat_window(self):
+        return ChatWindow(functools.partial(count_message_tokens, model = self.llm_model))
+    
+    # Tokens currently in the chat context with sender (defaults to the current conversation)
+    def context_tokens(self, sender = None):
+        return self.chat_messages[sender or self.sender_agent].total_tokens
+    
     # Read and return short term memories, either as string or list.
     def read_short_term_memory(self, list_mode = False):
         # Standard mode returns a joined string of memories
         if not list_mode:
-            with open(self.short_term_memory_path,'r') as f:
-                memories = '|'.join(f.readlines())
-            
-            # Store memories for consistent updated viewing.
-            return memories
+            return self.short_term_memory.as_string()
             
         # List_mode is used if the memories should be returned as a list instead of a joined string - used by memory manager
         else:
-            with open(self.short_term_memory_path,'r') as f:
-                return f.readlines()[0].split('|')
+            return self.short_term_memory.as_list()
     
-    # Append new short term memories to STM file.
+    # Append new short term memories to STM. Empty memories and repeats are dropped first, so they don't count toward the STM limit.
     def append_to_short_term_memory(self, memories):
-        with open(self.short_term_memory_path,'a') as f:
-            for memory in memories:
-                if memory != None:
-                    f.write(f"{memory}|")
+        memories = self.deduplicate_memories(memories)
+        if not memories:
+            return True
+        self.short_term_memory.append(memories)
+        self.compression_controller.record_memories(self.current_partition(), len(memories))
                     
         # Check if new additions cause STM to exceed limit
         if self.short_term_memory_full():
             # Debugging messages to monitor memory compression
-            print("DEBUG")
-            print("ATTEMPTING MEMORY COMPRESSION")
-            print("END DEBUG")
+            self.instrumentation.debug(DEBUG_SUMMARY, "Attempting memory compression")
             
             # TODO: add the summary of the stored memories to the bottom of short term using s_to_l_response. For now, return True
-            # BEWARE - bad settings could get you stuck in a loop, such as a minimal compression ratio
-            s_to_l_response = self.short_term_to_long_term()
-            print(s_to_l_response)
-            return True
-
+            # Queued behind the current job for this agent when running in the background.
+            s_to_l_response = self.run_memory_job(self.short_term_to_long_term)
+            self.instrumentation.debug(DEBUG_SUMMARY, lambda: f"Memory compression result: {s_to_l_response}")
+        
+        # Whether or not consolidation keeps up, STM stays within its token cap
+        self.archive_short_term_overflow()
         return True
     
+    # New memories without empty ones and repeats - of STM, of the most similar LTM entries, or of each other. Counts the ones dropped.
+    def deduplicate_memories(self, memories):
+        if isinstance(memories, str):
+            memories = [memories]
+        new_memories = [m.strip() for m in memories if m is not None and m.strip() != ""]
+        
+        threshold = self.DEFAULT_STM_DEDUP_SIMILARITY
+        kept = new_memories
+        if threshold is not None:
+            partition = self.current_partition()
+            stm = partition.short_term_memory.as_list()
+            seen = set(normalize_memory(m) for m in stm)
+            compared = [memory_shingles(m) for m in stm]
+            kept = []
+            for memory in new_memories:
+                normalized = normalize_memory(memory)
+                if normalized == "" or normalized in seen:
+                    continue
+                shingles = memory_shingles(memory)
+                if any(shingle_similarity(shingles, other) >= threshold for other in compared):
+                    continue
+                ltm_matches = partition.ltm_index.search(memory, k = self.DEFAULT_STM_DEDUP_LTM_CANDIDATES)
+                if any(shingle_similarity(shingles, memory_shingles(text)) >= threshold for _, _, text in ltm_matches):
+                    continue
+                seen.add(normalized)
+                compared.append(shingles)
+                kept.append(memory)
+        
+        suppressed = len(memories) - len(kept)
+        if suppressed:
+            self.current_partition().suppressed_memories += suppressed
+            self.instrumentation.count("stm_memories_suppressed", suppressed, agent = self.name)
+            self.instrumentation.debug(DEBUG_SUMMARY, lambda: f"Dropped {suppressed} empty or repeated memories")
+        return kept
+    
     # Logic for checking if short term memory has filled
-    # TODO: Catch None, "", and other pointless memories. Rewrite file to eliminate them and don't consider them in count.
+    # TODO: Catch other pointless memories. None, "" and repeats never make it into STM - see deduplicate_memories.
     def short_term_memory_full(self):
-        with open(self.short_term_memory_path,'r') as f:
-            num_memories = len(f.readlines()[0].split('|'))
+        num_memories = len(self.short_term_memory)
             
         if num_memories > self.DEFAULT_SHORT_TERM_MEMORY_LIMIT:
             return True
         else:
             return False
     
+    # Move the oldest STM memories to the archive until STM is within DEFAULT_STM_MAX_TOKENS. Returns the number moved.
+    def archive_short_term_overflow(self):
+        if self.DEFAULT_STM_MAX_TOKENS is None:
+            return 0
+        memories = self.short_term_memory.as_list()
+        excess = count_tokens(self.short_term_memory.as_string(), self.llm_model) - self.DEFAULT_STM_MAX_TOKENS
+        num = 0
+        while excess > 0 and num < len(memories):
+            excess -= count_tokens(memories[num], self.llm_model) + 1
+            num += 1
+        if num:
+            self.short_term_memory.move_oldest(num, "archive")
+            self.instrumentation.count("stm_memories_archived", num, agent = self.name)
+            self.instrumentation.debug(DEBUG_SUMMARY, lambda: f"STM over {self.DEFAULT_STM_MAX_TOKENS} tokens, archived its {num} oldest memories")
+        return num
+    
     # Call memory compression routine on STM - trim off some (FILO) - request memory manager to store it.    
     def short_term_to_long_term(self):
+        # A queued consolidation may find an earlier one already brought STM back under the limit.
+        if not self.short_term_memory_full():
+            return False
+        
+        # After failed consolidations, wait for more new memories rather than retrying on every append
+        partition = self.current_partition()
+        if not self.compression_controller.allow_consolidation(partition):
+            self.instrumentation.count("stm_consolidations_deferred", agent = self.name)
+            return False
 
         # memory manager rewrites the memory as normal, but without the trimmed off ones.
         # TODO: include a short statement/comment/line, very free form, that captures the "feeling" of the memories that just got tucked away. Add it to STM as supplicant for those lost in compression.
-        return self.memory_manager.short_to_long()
+        succeeded = False
+        try:
+            with self.borrowed_memory_manager() as manager:
+                succeeded = manager.short_to_long()
+        finally:
+            self.compression_controller.record_consolidation(partition, succeeded)
+        return succeeded
     
     # Attempt to retrieve information from LTM as it relates to a hint.
     def lookup_from_long_term_memory(self, hint):
         # Pass request on to MMA.
-        return self.memory_manager.lookup_from_long(hint)
+        with self.borrowed_memory_manager() as manager:
+            return manager.lookup_from_long(hint)
+    
+    # Awaitable lookup for async callers - runs in a thread, within the async memory job limit
+    async def a_lookup_from_long_term_memory(self, hint):
+        async with self.memory_job_semaphore:
+            return await asyncio.to_thread(self.lookup_from_long_term_memory, hint)
         
+    # Full text of a function result that was cut short for summarizing, by the digest shown in its place. Also in the function map,
+    # so the LLM gets a short note rather than None when nothing is kept under the digest.
+    def read_function_output(self, digest):
+        records = self.memory_store.find("function_output", str(digest).strip())
+        return records[0].content if records else f"No function output is kept under digest {digest}."
+    
     # Called by memory manager to reset short term memory after compression. Can be used to completely rewrite STM.
     def rewrite_short_term_memory(self, memories):
-        with open(self.short_term_memory_path, 'w') as f:
-            for memory in memories:
-                f.write(f"{memory}|")
+        self.short_term_memory.rewrite(memories)
+    
+    # Wait for this agents queued memory jobs to finish, then write any dirty memories to disk regardless of flush policy.
+    def flush_memories(self, timeout = None):
+        with self.partitions_lock:
+            partitions = list(self.memory_partitions.values())
+        flushed = False
+        for partition in partitions:
+            # Batched summaries are handed to the consolidation worker (or written to STM) before the worker is waited on
+            if self.memory_batch_scheduler is not None:
+                self.memory_batch_scheduler.flush(partition, timeout = timeout)
+            if self.consolidation_worker is not None:
+                self.consolidation_worker.flush(key = partition, timeout = timeout)
+            flushed = partition.short_term_memory.flush() or flushed
+        return flushed
 
+    async def a_flush_memories(self, timeout = None):
+        return await asyncio.to_thread(self.flush_memories, timeout)
+    
     # Get the function map to return to user proxy
     def get_function_map(self):
         f_map = {}
@@ -305,7 +2770,7 @@ class MemoryEnabledAgent_Manager(AssistantAgent):
     
     
     2. Incorporate information into long-term memory
-    You will be shown the existing long term memory, and a list of new memories which need to be incorporated. The memory is formatted as a series of statements seperated by the '|' character.
+    You will be shown a section of the existing long term memory, and a list of new memories which need to be incorporated. The section holds related memories; only rewrite the section you are shown. The memory is formatted as a series of statements seperated by the '|' character.
     For example, the existing memory might look like this:
         "{User's name} is allergic to seafood| {User's name} likes dogs| {User's name} is from Canada" 
     In this example, if you were requested to write a message to memory that was "{User's name} likes cats", when you go to rewrite the memory, it should look like this:
@@ -332,9 +2797,13 @@ class MemoryEnabledAgent_Manager(AssistantAgent):
     
     # Unused
     DEFAULT_SYSTEM_MESSAGE = """ This one is more about the task at hand for the agent """
+    
+    # Added to summarize prompts whose transcript has function results cut short, so the digest survives into STM for read_function_output
+    DEFAULT_DIGEST_INSTRUCTION = " Where a function result was cut short, keep its digest in the key point about it, as (digest <digest>)."
 
 
-    def __init__(self, parent_agent):
+    # A pooled manager (see MemoryManagerPool) gets its own name and the pools lookup cache, and its parent is whichever MEA borrowed it.
+    def __init__(self, parent_agent, name = None, lookup_cache = None):
         # Grab parent agent object and parent agent llm config info.
         self.parent_agent = parent_agent
         self.gpt_config = parent_agent.gpt_config
@@ -344,7 +2813,7 @@ class MemoryEnabledAgent_Manager(AssistantAgent):
         
         # Regular __init__ for AssistentAgent
         super().__init__(
-            name= parent_agent.name + "_MemoryManager",
+            name= name or parent_agent.name + "_MemoryManager",
             llm_config={
                 "temperature": 0,
                 "request_timeout": 600,
@@ -354,13 +2823,13 @@ class MemoryEnabledAgent_Manager(AssistantAgent):
                 "functions": [
                     {
                         "name": "rewrite_memory",
-                        "description": "Rewrites the entire memory to incorporate new information in a smart, condensed, entity focused way.",
+                        "description": "Rewrites the memory section you were shown to incorporate new information in a smart, condensed, entity focused way.",
                         "parameters": {
                             "type": "object",
                             "properties": {
                                 "memories": {
                                     "type": "string",
-                                    "description": "the rewritten memory. Contains all the information from existing memory as well as the new information.",
+                                    "description": "the rewritten memory section. Contains all the information from the existing section as well as the new information.",
                                 },
                             },
                             "required": ["memories"],
@@ -383,14 +2852,66 @@ class MemoryEnabledAgent_Manager(AssistantAgent):
                             "required": ["memories"]
                         }
                     },
-                    
+                    {
+                        "name": "append_to_short_term_memory_batch",
+                        "description": "Writes the memories from each of several conversation sections to memory.",
+                        "parameters": {
+                            "type": "object",
+                            "properties": {
+                                "sections": {
+                                    "type": "array",
+                                    "items": {
+                                        "type": "object",
+                                        "properties": {
+                                            "section": {"type": "integer", "description": "number of the conversation section"},
+                                            "memories": {
+                                                "type": "array",
+                                                "items": {"type": "string"},
+                                                "description": "key points from that section. Make sure each string is context complete, such that an outsider would understand it.",
+                                            },
+                                        },
+                                        "required": ["section", "memories"],
+                                    },
+                                },
+                            },
+                            "required": ["sections"]
+                        }
+                    },
                     
                 ],
             },
             system_message = self.DEFAULT_MEM_MANAGER_MESSAGE,
         )
         
-        # These are dummy user_agents to allow MMA code execution. There needs to be two as conversation histories were cross-contaminating on consequetive function calls.
+        # 'direct' or 'chat' - see MemoryEnabledAgent.DEFAULT_MEMORY_MANAGER_MODE
+        self.mode = self.parent_agent.DEFAULT_MEMORY_MANAGER_MODE
+        
+        # These are dummy user_agents to allow MMA code execution in chat mode. There needs to be two as conversation histories were cross-contaminating on consequetive function calls.
+        self.function_agent_LTM = None
+        self.function_agent_STM = None
+        if self.mode == "chat":
+            self.create_function_agents()
+        
+        # Background consolidation and foreground lookups share these agents and chat histories - only one MMA chat at a time.
+        self.chat_lock = threading.RLock()
+        
+        # Which LTM shard a rewrite_memory call is for while the MMA is consolidating, the ids of the memories it takes in, and whether
+        # the MMA called it. LTM itself lives in the parents current memory partition.
+        self.rewriting_shard = None
+        self.rewriting_ids = ()
+        self.rewrote_shard = False
+        
+        # Lookup results keyed on (partition path, LTM content hash, normalized hint) - repeat questions skip the LLM until LTM changes
+        self.lookup_cache = lookup_cache if lookup_cache is not None else MemoryCallCache(
+            max_bytes = self.parent_agent.DEFAULT_LOOKUP_CACHE_MAX_BYTES,
+            ttl_seconds = self.parent_agent.DEFAULT_LOOKUP_CACHE_TTL_SECONDS,
+        )
+        
+        # Time and count the MMAs LLM calls with the parents instrumentation
+        instrument_oai_replies(self)
+        self.system_message_tokens = None
+    
+    def create_function_agents(self):
         self.function_agent_LTM = UserProxyAgent(
             name="user_proxy_for_LTM",
             is_termination_msg= self.is_mem_termination_msg,
@@ -405,9 +2926,60 @@ class MemoryEnabledAgent_Manager(AssistantAgent):
             human_input_mode="NEVER",
             max_consecutive_auto_reply=1,
             code_execution_config={"work_dir": "_test"},
-            function_map={"append_to_short_term_memory": self.parent_agent.append_to_short_term_memory}
+            function_map={"append_to_short_term_memory": self.append_to_short_term_memory}
             )
     
+    # Resolved on every call, so a pooled MMA writes to whichever MEA borrowed it
+    def append_to_short_term_memory(self, memories):
+        return self.parent_agent.append_to_short_term_memory(memories)
+    
+    # The MMA reports to its parents instrumentation
+    @property
+    def instrumentation(self):
+        return self.parent_agent.instrumentation
+    
+    # MMA chats are only printed when dumping debug payloads
+    def silent_chats(self):
+        return self.instrumentation.verbosity < DEBUG_PAYLOADS
+    
+    # Direct mode: one completion for a memory operation - the system prompt and this message only, no chat history kept
+    def direct_completion(self, message):
+        final, reply = instrumented_oai_reply(self, messages = [{"content": message, "role": "user"}])
+        return reply
+    
+    # Direct mode: run the function call in a completion reply if it names one of function_map. Returns the function result, or None
+    # if the MMA answered without a usable function call - arguments that don't fit the function definitions schema, or a call that
+    # fails. Like the UserProxy in chat mode, a bad call never escapes into the parents conversation.
+    def run_function_call(self, reply, function_map):
+        function_call = reply.get("function_call") if isinstance(reply, dict) else None
+        name = function_call.get("name") if function_call else None
+        function = function_map.get(name)
+        if function is None:
+            self.instrumentation.debug(DEBUG_SUMMARY, lambda: f"MMA reply has no call to {', '.join(function_map)}: {reply}")
+            return None
+        parameters = next((f["parameters"] for f in self.llm_config.get("functions", ()) if f["name"] == name), {})
+        try:
+            arguments = json.loads(function_call.get("arguments") or "{}")
+            mismatch = schema_mismatch(arguments, parameters)
+            if mismatch:
+                raise TypeError(mismatch)
+            inspect.signature(function).bind(**arguments)
+        except (ValueError, TypeError) as e:
+            self.instrumentation.debug(DEBUG_SUMMARY, lambda: f"MMA made an unusable call to {name}: {e!r}")
+            return None
+        try:
+            return function(**arguments)
+        except Exception as e:
+            self.instrumentation.count("memory_job_errors", agent = self.parent_agent.name)
+            self.instrumentation.debug(DEBUG_SUMMARY, lambda: f"MMA call to {name} failed: {e!r}")
+            return None
+    
+    # Tokens sent for a memory operation - the system prompt, counted once, and message
+    def prompt_tokens(self, message):
+        if self.system_message_tokens is None:
+            self.system_message_tokens = count_tokens(self.system_message, self.llm_model)
+        return self.system_message_tokens + count_tokens(message, self.llm_model)
+    
     # Function to automate LTM/STM operations
     def is_mem_termination_msg(self, msg):
         if msg.get("content") != None:
@@ -417,22 +2989,50 @@ class MemoryEnabledAgent_Manager(AssistantAgent):
         
     
     # Present the memory manager with the lost messages to summarize into parent agents short term memory. Will call append_to_short_term_memory in parent MEA and pass in memories.
+    # The messages are sent as a compact transcript. Function results cut short in it are kept whole in the 'function_output' tier, under their digest.
     def process_chat_section(self, lost_messages):
-        self.function_agent_STM.initiate_chat(
-            self,
-            message=f"Conversation Section to Summarize:\n{lost_messages}\n\n Please make a function call to append_to_short_term_memory and pass in the key points you can extract from the above conversation section. Do not use 'User' or 'Assistant' - replace 'User' with {self.parent_agent.sender_agent.name}, and replace 'Assistant' with 'I'."
-        )      
+        partition = self.parent_agent.current_partition()
+        sender_name = partition.sender_name
+        transcript, digested = render_transcript(lost_messages, self.parent_agent.DEFAULT_SUMMARY_FUNCTION_OUTPUT_TOKENS, self.llm_model)
+        if not transcript:
+            return
+        partition.keep_function_outputs(digested)
+        message = f"Conversation Section to Summarize:\n{transcript}\n\n Please make a function call to append_to_short_term_memory and pass in the key points you can extract from the above conversation section. Do not use 'User' or 'Assistant' - replace 'User' with {sender_name}, and replace 'Assistant' with 'I'."
+        if digested:
+            message += self.DEFAULT_DIGEST_INSTRUCTION
+        self.parent_agent.compression_controller.record_summarize(len(lost_messages), self.prompt_tokens(message), count_tokens(transcript, self.llm_model))
+        with self.instrumentation.span("summarize", agent = self.parent_agent.name):
+            if self.mode == "direct":
+                self.run_function_call(self.direct_completion(message), {"append_to_short_term_memory": self.append_to_short_term_memory})
+                return
+            with self.chat_lock:
+                self.function_agent_STM.initiate_chat(self, silent = self.silent_chats(), message = message)
+    
+    # Summarize the chat sections of several MemoryBatchJobs, from any agents, in one direct completion. Returns the memories for each job,
+    # in order, or None for a job the MMA gave no usable result for.
+    def process_chat_sections(self, jobs):
+        sections = "\n\n".join(f"Section {number} (replace 'User' with {job.partition.sender_name}):\n{job.transcript}" for number, job in enumerate(jobs, 1))
+        message = f"Conversation Sections to Summarize:\n\n{sections}\n\n Please make a function call to append_to_short_term_memory_batch and pass in, for every section, its number and the key points you can extract from that section alone. Do not use 'User' or 'Assistant' - replace 'User' with the name given for the section, and replace 'Assistant' with 'I'."
+        if any(job.digested for job in jobs):
+            message += self.DEFAULT_DIGEST_INSTRUCTION
+        results = {}
+        def collect(sections):
+            for entry in sections if isinstance(sections, list) else []:
+                memories = entry.get("memories") if isinstance(entry, dict) else None
+                if isinstance(memories, list) and all(isinstance(m, str) for m in memories) and isinstance(entry.get("section"), int):
+                    results[entry["section"]] = memories
+            return True
+        
+        tokens = self.prompt_tokens(message)
+        with self.instrumentation.span("summarize_batch", agent = self.parent_agent.name):
+            self.run_function_call(self.direct_completion(message), {"append_to_short_term_memory_batch": collect})
+        for job in jobs:
+            job.agent.compression_controller.record_summarize(len(job.lost_messages), tokens*job.tokens//max(1, sum(j.tokens for j in jobs)), job.tokens)
+        return [results.get(number) for number in range(1, len(jobs) + 1)]
     
     # Return the full long term memory in list form
     def read_long_term_memory(self):
-        with open(self.parent_agent.long_term_memory_path, 'r') as f:
-            mems =  f.readlines()
-     
-        if len(mems) == 0:
-            return []
-        
-        else:
-            return mems[0].split('|')       
+        return self.parent_agent.current_partition().ltm_shards.entries()
             
     # Trim off tail of short term memory to incorporate into long (FILO)
     # TODO: Have MMA return a single point summary of the condensed memories to affix to STM as shadow of now missing memories.
@@ -440,44 +3040,167 @@ class MemoryEnabledAgent_Manager(AssistantAgent):
         # Get the memories in list mode
         mems = self.parent_agent.read_short_term_memory(list_mode = True)
         # Determine trim point using STM Compression Ratio
-        trim_num = int(len(mems)*self.parent_agent.DEFAULT_COMPRESSION_RATIO_STM)
-        # Split between mems to leave (stay in STM) and mems to store (into LTM)
-        mems_to_leave = mems[trim_num:]
-        mems_to_store = mems[:trim_num]
-        # Rewrite STM with shortened memory list
-        self.parent_agent.rewrite_short_term_memory(mems_to_leave)
+        trim_num = self.parent_agent.compression_controller.stm_trim_count(len(mems))
+        # Move mems to store (into LTM) out of STM in one transaction. They wait in the 'consolidating' tier, so nothing is lost if incorporation fails.
+        staged = self.parent_agent.short_term_memory.move_oldest(trim_num, "consolidating")
+        mems_to_store = [content for memory_id, content in staged]
         
-        # Call incorporate_memories, return result.
-        return self.incorporate_memories(mems_to_store)
+        # Each shard the MMA rewrites drops the staged copies it took in, in the same transaction. Memories it couldn't incorporate go
+        # back to the front of STM, to be tried again with the next consolidation - if incorporation fails part way, every staged
+        # memory no finished shard took in.
+        try:
+            with self.instrumentation.span("stm_to_ltm", agent = self.parent_agent.name):
+                failed_ids = self.incorporate_memories(mems_to_store, [memory_id for memory_id, content in staged])
+        except Exception:
+            still_staged = {record.id for record in self.parent_agent.current_partition().store.read("consolidating")}
+            self.parent_agent.short_term_memory.restore([(memory_id, content) for memory_id, content in staged if memory_id in still_staged])
+            raise
+        if failed_ids:
+            self.instrumentation.debug(DEBUG_SUMMARY, lambda: f"{len(failed_ids)} memories were not incorporated into LTM, returned to STM")
+            self.parent_agent.short_term_memory.restore([(memory_id, content) for memory_id, content in staged if memory_id in failed_ids])
+        return not failed_ids
         
-    # Present MMA with full LTM, trimmed of STM, and have it redo LTM to incorporate STM
+    # Route memories to the LTM shards they belong to, then present MMA with each affected shard and have it redo that shard to incorporate them.
+    # Cost per consolidation depends on shard size, not total LTM size. memory_ids are the store ids of memories staged in the 'consolidating'
+    # tier - each shard step deletes the ones it incorporated along with the shard rewrite. Returns the ids of memories that were not incorporated.
     # TODO: Tune prompt/function defs to ensure smart compression
     # TODO: Return STM shadow
-    def incorporate_memories(self, memories):
-        self.function_agent_LTM.initiate_chat(
-            self,
-            message=f"Full Long Term Memory:\n{self.read_long_term_memory()}\n\nNew memory or memories to incorporate:\n{'|'.join(memories)} \n\n Please make a function call to rewrite_memory and pass in the reconfigured long term memory which incorporates the old with the new. It is better to modify memories in place to capture new information instead of always making the memory longer; only make it longer if necessary, but otherwise do your best to condense, reorganize, and rewrite. The goal is for the Long Term Memory you are writing to be as entity dense as possible."
-        )
-        return True
+    def incorporate_memories(self, memories, memory_ids = ()):
+        partition = self.parent_agent.current_partition()
+        ids_by_memory = defaultdict(list)
+        for memory_id, memory in zip(memory_ids, memories):
+            ids_by_memory[(memory or "").strip()].append(memory_id)
+        failed_ids = set()
+        
+        for shard_id, shard_memories in partition.ltm_shards.route(memories).items():
+            shard_memory_ids = [ids_by_memory[memory].pop() for memory in shard_memories if ids_by_memory[memory]]
+            
+            # Nothing in LTM to merge with - the memories become a new shard as they are, no LLM call needed
+            if shard_id is None:
+                with partition.ltm_shards.lock, partition.store.atomic():
+                    partition.ltm_shards.new_shard(shard_memories)
+                    partition.store.delete(shard_memory_ids)
+                continue
+            
+            message = f"Long Term Memory Section:\n{partition.ltm_shards.get(shard_id)}\n\nNew memory or memories to incorporate:\n{'|'.join(shard_memories)} \n\n Please make a function call to rewrite_memory and pass in the reconfigured long term memory section which incorporates the old with the new. It is better to modify memories in place to capture new information instead of always making the memory longer; only make it longer if necessary, but otherwise do your best to condense, reorganize, and rewrite. The goal is for the Long Term Memory you are writing to be as entity dense as possible."
+            # Direct mode passes the shard along with the call, so consolidations for different senders can run at once
+            if self.mode == "direct":
+                rewritten = self.run_function_call(self.direct_completion(message), {"rewrite_memory": functools.partial(self.rewrite_shard, shard_id, consumed_ids = shard_memory_ids)})
+            else:
+                with self.chat_lock:
+                    self.rewriting_shard, self.rewriting_ids, self.rewrote_shard = shard_id, shard_memory_ids, False
+                    try:
+                        self.function_agent_LTM.initiate_chat(self, silent = self.silent_chats(), message = message)
+                        rewritten = self.rewrote_shard
+                    finally:
+                        self.rewriting_shard, self.rewriting_ids = None, ()
+            # Prompt and rewritten shard, for the compression controller
+            self.parent_agent.compression_controller.record_consolidate(self.prompt_tokens(message) + partition.ltm_shards.shard_tokens.get(shard_id, 0))
+            if not rewritten:
+                failed_ids.update(shard_memory_ids)
+                continue
+            
+            partition.ltm_shards.split_if_oversized(shard_id)
+        
+        # Memories with nothing to incorporate (empty) are dropped
+        partition.store.delete([memory_id for ids in ids_by_memory.values() for memory_id in ids])
+        
+        self.archive_cold_memories(partition)
+        
+        # Keep the lookup index in step - only changed entries are touched. Cached lookups are now stale.
+        partition.ltm_index.sync(partition.ltm_shards.entries())
+        self.lookup_cache.invalidate(partition.path)
+        return failed_ids
     
-    # Rewrite entire LTM, from list, with formatting
+    # Keep the hot LTM within DEFAULT_LTM_HOT_MAX_TOKENS by archiving its least recently used entries
+    def archive_cold_memories(self, partition):
+        archived = partition.ltm_shards.archive_coldest(self.parent_agent.DEFAULT_LTM_HOT_MAX_TOKENS)
+        if archived:
+            self.instrumentation.count("ltm_archived", len(archived), agent = self.parent_agent.name)
+            self.instrumentation.debug(DEBUG_SUMMARY, lambda: f"Archived {len(archived)} LTM entries, {partition.ltm_shards.num_tokens} tokens left in hot LTM")
+        return archived
+    
+    # Rewrite the LTM shard being consolidated, from list, with formatting. Outside a consolidation, rewrites the entire LTM as a single shard.
     def rewrite_memory(self, memories):
+        self.rewrote_shard = self.rewrite_shard(self.rewriting_shard, memories, self.rewriting_ids)
+        return self.rewrote_shard
+    
+    # Rewrite one LTM shard, or the entire LTM if shard_id is None. The staged memories with consumed_ids are deleted in the same
+    # transaction, so after a crash they are either in LTM or still waiting to be incorporated - never both, never neither.
+    def rewrite_shard(self, shard_id, memories, consumed_ids = ()):
+        partition = self.parent_agent.current_partition()
         memory_list = memories.split('|')
-        with open(self.parent_agent.long_term_memory_path, 'w') as f:
-            for memory in memory_list:
-                f.write(f"{memory}|")
+        # Lookups see the shards before or after the rewrite, never an LTM emptied for a full rewrite
+        with partition.ltm_shards.lock, partition.store.atomic():
+            if shard_id is not None:
+                partition.ltm_shards.set(shard_id, memory_list)
+            else:
+                for existing_shard in list(partition.ltm_shards.shards):
+                    partition.ltm_shards.set(existing_shard, [])
+                partition.ltm_shards.new_shard(memory_list)
+            partition.store.delete(consumed_ids)
+        self.archive_cold_memories(partition)
+        
+        # Keep the lookup index in step - only changed entries are touched. Cached lookups are now stale.
+        partition.ltm_index.sync(partition.ltm_shards.entries())
+        self.lookup_cache.invalidate(partition.path)
                 
         return True       
     
     # Called by MEA - request for information from LTM relating to hint.
     # TODO: improve hint response
     def lookup_from_long(self, hint):
-        self.function_agent_LTM.initiate_chat(
-            self,
-            message=f"Full Long Term Memory:\n{self.read_long_term_memory()}\n\nWhat do I know about: {hint}?\n\n Respond in chat - Do not make a function call. Replace 'you' with {self.parent_agent.sender_agent.name}. End with TERMINATE."
-        )
-        # Send back the response to the conversing agent. Due to current flow and manual exiting, '-3' is magic number that gets original MMA response to question.
-        return self.chat_messages[self.function_agent_LTM][-1]
+        partition = self.parent_agent.current_partition()
+        
+        with self.instrumentation.span("lookup", agent = self.parent_agent.name):
+            # Same question about the same LTM - reuse the answer. Hints are compared by their sorted terms, so rewordings like "Andy's dogs?" and "andy dog" match.
+            cache_key = (partition.path, partition.ltm_shards.content_hash(), " ".join(sorted(set(tokenize_memory(hint)))) or hint.strip().lower())
+            cached = self.lookup_cache.get(cache_key)
+            if cached is not None:
+                return dict(cached)
+            
+            response = self.lookup_from_long_uncached(partition, hint)
+            self.lookup_cache.put(cache_key, dict(response))
+            return response
+    
+    def lookup_from_long_uncached(self, partition, hint):
+        top_k = self.parent_agent.DEFAULT_LOOKUP_TOP_K
+        
+        # Small LTM goes in whole, as before. Otherwise rank entries locally and only show the MMA the best matches.
+        if len(partition.ltm_index) <= top_k and not partition.store.count("archive"):
+            relevant_memories = partition.ltm_shards.entries()
+        else:
+            matches = partition.ltm_index.search(hint, k = top_k)
+            partition.ltm_shards.touch([text for score, confidence, text in matches])
+            
+            # Confident local match - answer with the matching entries and skip the LLM entirely
+            confident = [text for score, confidence, text in matches if confidence >= self.parent_agent.DEFAULT_LOOKUP_DIRECT_CONFIDENCE]
+            if confident:
+                return {"content": "|".join(confident), "role": "assistant"}
+            
+            relevant_memories = [text for score, confidence, text in matches]
+            
+            # Hot LTM miss - nothing matched, or only on words most entries have. The best archive matches go in front.
+            if partition.store.count("archive") and not any(confidence for score, confidence, text in matches):
+                self.instrumentation.count("ltm_archive_lookups", agent = self.parent_agent.name)
+                relevant_memories = [record.content for record in partition.store.search("archive", hint, limit = top_k)] + relevant_memories
+            
+            if not relevant_memories:
+                return {"content": f"I don't know anything about {hint}", "role": "assistant"}
+        
+        message = f"Relevant Long Term Memory:\n{relevant_memories}\n\nWhat do I know about: {hint}?\n\n Respond in chat - Do not make a function call. Replace 'you' with {partition.sender_name}. End with TERMINATE."
+        
+        # Direct mode shares no state with consolidation, so lookups never wait for it
+        if self.mode == "direct":
+            reply = self.direct_completion(message)
+            content = reply.get("content") if isinstance(reply, dict) else reply
+            return {"content": (content or "").rstrip().removesuffix("TERMINATE").rstrip(), "role": "assistant"}
+        
+        # Lookups are on the reply path, so they only wait for the MMA chat in progress - not for queued consolidation.
+        with self.chat_lock:
+            self.function_agent_LTM.initiate_chat(self, silent = self.silent_chats(), message = message)
+            # Send back the response to the conversing agent. Due to current flow and manual exiting, '-3' is magic number that gets original MMA response to question.
+            return self.chat_messages[self.function_agent_LTM][-1]
 
 
 
@@ -0,0 +1,9 @@
+# Offline benchmarks for MemoryEnabledAgent. Nothing here needs an API key or network - see fake_llm.py.
+# Run from the repository root, e.g.  python -m benchmarks.memory_agent --turns 1000
+import os
+import sys
+
+# EnhancedAgents is a flat module in the repository root - keep it importable after benchmarks chdir into a scratch directory
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPOSITORY_ROOT not in sys.path:
+    sys.path.insert(0, REPOSITORY_ROOT)
@@ -0,0 +1,145 @@
+# Fleet benchmark for MemoryBatchScheduler: many MEAs hold conversations at once, and every chat trim is summarized either with its
+# own LLM call (individual) or batched with other agents' trims (batched). Reports memory operations per LLM call.
+#
+#   python -m benchmarks.batching --agents 8 --turns 200 --llm-latency-ms 20 --output batching.json
+#   python -m benchmarks.batching --agents 8 --turns 200 --llm-latency-ms 20 --window-ms 100 --baseline batching.json
+#
+# Every conversation runs in its own thread, like a server answering many users. Each variant runs in a fresh process in a scratch
+# directory. Results are JSON: chat sections summarized, summarize LLM calls and sections per call, prompt tokens, turn latency
+# percentiles, wall time, memories stored and the schedulers counters.
+import argparse
+import contextlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from benchmarks import REPOSITORY_ROOT, common
+from benchmarks.conversation import synthetic_conversation
+from benchmarks.fake_llm import FakeLLM
+from benchmarks.memory_agent import DiscardOutput
+
+VARIANTS = ["individual", "batched"]
+
+
+def run_variant(variant, args, verbose = False):
+    if verbose:
+        return run_fleet(variant, args)
+    with contextlib.redirect_stdout(DiscardOutput()):
+        return run_fleet(variant, args)
+
+
+def run_fleet(variant, args):
+    import autogen
+    from EnhancedAgents import MemoryBatchScheduler, MemoryEnabledAgent
+    
+    workdir = tempfile.mkdtemp(prefix = "mea_batching_")
+    os.chdir(workdir)
+    
+    llm = FakeLLM(latency_ms = args.llm_latency_ms)
+    llm.install()
+    
+    scheduler = None
+    if variant == "batched":
+        scheduler = MemoryBatchScheduler(
+            window_ms = args.window_ms,
+            max_batch_jobs = args.max_batch_jobs,
+            max_calls_per_minute = args.max_calls_per_minute,
+        )
+    gpt_config = {"config_list": [{"model": "gpt-3.5-turbo", "api_key": "offline"}]}
+    agents = [MemoryEnabledAgent(f"Agent_{number}", gpt_config, memory_batch_scheduler = scheduler) for number in range(args.agents)]
+    
+    latencies = []
+    latencies_lock = threading.Lock()
+    def converse(number, agent):
+        user = autogen.UserProxyAgent(f"User_{number}", human_input_mode = "NEVER", max_consecutive_auto_reply = 0, code_execution_config = False)
+        user.initiate_chat(agent, message = f"(User:User_{number} Connected)", silent = True)
+        for message in synthetic_conversation(args.turns, args.seed + number):
+            start = time.perf_counter()
+            user.send(message, agent, request_reply = True, silent = True)
+            with latencies_lock:
+                latencies.append((time.perf_counter() - start)*1000)
+    
+    start = time.perf_counter()
+    threads = [threading.Thread(target = converse, args = (number, agent)) for number, agent in enumerate(agents)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    conversation_seconds = time.perf_counter() - start
+    
+    # Summaries still waiting in the scheduler or on the worker count toward cost, not toward turn latency
+    drain_start = time.perf_counter()
+    for agent in agents:
+        agent.flush_memories()
+    drain_seconds = time.perf_counter() - drain_start
+    
+    llm_stats = llm.stats()
+    calls = llm_stats["calls"]
+    summarize_calls = calls.get("summarize", 0) + calls.get("summarize_batch", 0)
+    sections = scheduler.stats()["completed"] if scheduler else calls.get("summarize", 0)
+    result = {
+        "conversations": args.agents,
+        "turn_latency_ms": common.percentiles(latencies),
+        "conversation_seconds": conversation_seconds,
+        "drain_seconds": drain_seconds,
+        "summarize": {
+            "sections": sections,
+            "llm_calls": summarize_calls,
+            "sections_per_call": sections/summarize_calls if summarize_calls else 0.0,
+            "prompt_tokens": llm_stats["prompt_tokens"].get("summarize", 0) + llm_stats["prompt_tokens"].get("summarize_batch", 0),
+            "calls_per_second": summarize_calls/(conversation_seconds + drain_seconds),
+        },
+        "llm_calls": calls,
+        "memories": sum(agent.memory_partition(f"User_{number}").store.count(tier) for number, agent in enumerate(agents) for tier in ("stm", "ltm")),
+        "scheduler": scheduler.stats() if scheduler else None,
+        "worker_errors": agents[0].consolidation_worker.num_errors if agents[0].consolidation_worker else 0,
+    }
+    
+    os.chdir(REPOSITORY_ROOT)
+    shutil.rmtree(workdir, ignore_errors = True)
+    return result
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Offline memory summarization batching benchmark with a fake LLM.")
+    parser.add_argument("--agents", type = int, default = 8, help = "MEAs, each in one conversation on its own thread")
+    parser.add_argument("--turns", type = int, default = 200, help = "user messages per conversation")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--variants", default = ",".join(VARIANTS), help = f"comma separated variants: {', '.join(VARIANTS)}")
+    parser.add_argument("--llm-latency-ms", type = float, default = 20, help = "simulated time per LLM call")
+    parser.add_argument("--window-ms", type = float, default = 50, help = "how long a batch waits for more chat sections")
+    parser.add_argument("--max-batch-jobs", type = int, default = 8, help = "most chat sections per batch")
+    parser.add_argument("--max-calls-per-minute", type = int, help = "rate limit on batches")
+    parser.add_argument("--output", help = "write JSON results here instead of stdout")
+    parser.add_argument("--baseline", help = "JSON results of an earlier run to compare against")
+    parser.add_argument("--verbose", action = "store_true", help = "show the agents' console output")
+    args = parser.parse_args(argv)
+    
+    results = {
+        "benchmark": "batching",
+        "agents": args.agents,
+        "turns": args.turns,
+        "seed": args.seed,
+        "llm_latency_ms": args.llm_latency_ms,
+        "window_ms": args.window_ms,
+        "max_batch_jobs": args.max_batch_jobs,
+        "environment": common.environment(),
+        "configs": {},
+    }
+    
+    context = multiprocessing.get_context("spawn")
+    for variant in args.variants.split(","):
+        with context.Pool(1) as pool:
+            results["configs"][variant] = pool.apply(run_variant, (variant, args, args.verbose))
+    
+    common.write_results(results, args.output)
+    if args.baseline:
+        common.print_comparison(common.load_results(args.baseline), results)
+    return results
+
+
+if __name__ == "__main__":
+    main()
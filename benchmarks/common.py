@@ -0,0 +1,106 @@
+# Shared helpers for the benchmarks: percentiles, process stats, JSON results and comparison against a baseline run.
+import json
+import platform
+import resource
+import sys
+import time
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    ordered = sorted(values)
+    def at(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction*len(ordered)))]
+    return {
+        "mean": sum(ordered)/len(ordered),
+        "p50": at(0.50),
+        "p90": at(0.90),
+        "p99": at(0.99),
+        "max": ordered[-1],
+    }
+
+
+# Read/write syscalls and bytes for this process. Linux only - empty elsewhere.
+def process_io():
+    try:
+        with open("/proc/self/io") as f:
+            return {key: int(value) for key, value in (line.split(": ") for line in f.read().splitlines())}
+    except OSError:
+        return {}
+
+
+def io_delta(before, after):
+    return {
+        "read_syscalls": after.get("syscr", 0) - before.get("syscr", 0),
+        "write_syscalls": after.get("syscw", 0) - before.get("syscw", 0),
+        "read_bytes": after.get("rchar", 0) - before.get("rchar", 0),
+        "write_bytes": after.get("wchar", 0) - before.get("wchar", 0),
+    }
+
+
+# Peak resident set size of this process so far, in MB
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak/(1024*1024) if sys.platform == "darwin" else peak/1024
+
+
+# Current resident set size of this process, in MB. Linux only - 0 elsewhere.
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1])*resource.getpagesize()/(1024*1024)
+    except OSError:
+        return 0.0
+
+
+# The DEFAULT_* settings of an agent class
+def agent_settings(agent_class):
+    return {name: getattr(agent_class, name) for name in dir(agent_class) if name.startswith("DEFAULT_") and not name.endswith("_MESSAGE")}
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def write_results(results, path = None):
+    text = json.dumps(results, indent = 2, sort_keys = True, default = str)
+    if path:
+        with open(path, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+# Numeric leaves of nested dicts as {"a.b.c": value}
+def flatten(results, prefix = ""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+# Print every metric both runs share, with the relative change from baseline to current
+def print_comparison(baseline, current, stream = sys.stderr):
+    before = flatten(baseline.get("configs", {}))
+    after = flatten(current.get("configs", {}))
+    print(f"{'metric':60} {'baseline':>14} {'current':>14} {'change':>9}", file = stream)
+    for metric in sorted(before.keys() & after.keys()):
+        if ".settings." in metric:
+            continue
+        old, new = before[metric], after[metric]
+        change = f"{(new - old)/old*100:+.1f}%" if old else ""
+        print(f"{metric:60} {old:14.4g} {new:14.4g} {change:>9}", file = stream)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,29 @@
+# Synthetic, seeded conversations - the same seed always produces the same messages, so runs are comparable.
+import random
+
+RELATIONS = ["sister", "brother", "friend", "neighbour", "cousin", "coworker", "uncle", "aunt"]
+NAMES = ["Alice", "Bruno", "Chen", "Dana", "Emeka", "Farah", "Goran", "Hana", "Ivan", "Jun", "Kofi", "Lena", "Mateo", "Nadia", "Omar", "Priya"]
+INTERESTS = ["hiking", "chess", "jazz", "baking bread", "rock climbing", "old films", "gardening", "astronomy", "sailing", "poetry", "cycling", "pottery"]
+SMALL_TALK = ["How are you today?", "Thanks for listening.", "It is raining here again.", "I had a long day at work."]
+
+
+# Yields one user message per turn: mostly new facts, with small talk every smalltalk_every turns, a question
+# about an earlier fact every question_every turns (which makes the MEA look it up in long term memory), and, if
+# restate_every is set, an earlier fact told again every restate_every turns. With unique_names every fact is about a new
+# person, so questions are mostly about facts that have long left the chat context and STM.
+def synthetic_conversation(turns, seed = 0, question_every = 10, smalltalk_every = 7, restate_every = 0, unique_names = False):
+    rng = random.Random(seed)
+    known = []
+    facts = []
+    for turn in range(1, turns + 1):
+        if known and question_every and turn % question_every == 0:
+            yield f"Do you remember what {rng.choice(known)} loves?"
+        elif smalltalk_every and turn % smalltalk_every == 0:
+            yield rng.choice(SMALL_TALK)
+        elif facts and restate_every and turn % restate_every == 0:
+            yield f"Like I said before. {rng.choice(facts)}"
+        else:
+            name = rng.choice(NAMES) + (str(turn) if unique_names else "")
+            known.append(name)
+            facts.append(f"My {rng.choice(RELATIONS)} {name} loves {rng.choice(INTERESTS)}.")
+            yield facts[-1]
@@ -0,0 +1,124 @@
+# Deterministic stand-in for the OpenAI chat endpoint. Patches autogen.oai.ChatCompletion.create so MEAs and MMAs run with no
+# network or API key, and answers every prompt the memory system sends with a scripted response built from the prompt itself.
+import ast
+import json
+import re
+import threading
+import time
+from collections import Counter
+
+import autogen
+
+from EnhancedAgents import MemoryEnabledAgent_Manager, count_message_tokens
+
+# Statements and questions produced by conversation.py
+STATEMENT = re.compile(r"My (\w+) (\w+) loves ([\w ]+?)\.")
+QUESTION = re.compile(r"Do you remember what (\w+) loves\?")
+
+
+class FakeLLM:
+
+    def __init__(self, latency_ms = 0):
+        # Simulated round trip per call, so background memory work has something to overlap
+        self.latency_ms = latency_ms
+        self.lock = threading.Lock()
+
+        # Per kind of call: chat, summarize, summarize_batch, consolidate, lookup, manager
+        self.calls = Counter()
+        self.prompt_tokens = Counter()
+        self.completion_tokens = Counter()
+
+        # Calls made on the thread driving the conversation - the ones a user waits for
+        self.reply_path_calls = 0
+
+        self.original_create = None
+
+    def install(self):
+        self.original_create = autogen.oai.ChatCompletion.create
+        autogen.oai.ChatCompletion.create = self.create
+
+    def uninstall(self):
+        autogen.oai.ChatCompletion.create = self.original_create
+
+    # Same call signature and response shape AutoGen expects from ChatCompletion.create
+    def create(self, context = None, messages = None, **config):
+        kind, message = self.respond(messages)
+        model = config.get("model", "gpt-3.5-turbo")
+        prompt_tokens = sum(count_message_tokens(m, model) for m in messages)
+        completion_tokens = count_message_tokens(message, model)
+
+        with self.lock:
+            self.calls[kind] += 1
+            self.prompt_tokens[kind] += prompt_tokens
+            self.completion_tokens[kind] += completion_tokens
+            if threading.current_thread() is threading.main_thread():
+                self.reply_path_calls += 1
+
+        if self.latency_ms:
+            time.sleep(self.latency_ms/1000)
+
+        return {
+            "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    # Returns (kind of call, assistant message)
+    def respond(self, messages):
+        last = messages[-1]
+        content = last.get("content") or ""
+
+        if messages[0].get("content") != MemoryEnabledAgent_Manager.DEFAULT_MEM_MANAGER_MESSAGE:
+            # MEA talking to the user
+            if last.get("role") == "function":
+                return "chat", {"role": "assistant", "content": "Thanks - that matches what I remember."}
+            question = QUESTION.search(content)
+            if question:
+                # Answer from context when the fact is in it (chat, STM or prefetched LTM), like a model would - otherwise look it up
+                fact = re.compile(rf"\b{question.group(1)} loves \w")
+                if any(fact.search(m.get("content") or "") for m in messages):
+                    return "chat", {"role": "assistant", "content": "Yes, I remember that."}
+                return "chat", function_call("lookup_from_long_term_memory", {"hint": f"what {question.group(1)} loves"})
+            return "chat", {"role": "assistant", "content": "Noted, thanks for telling me."}
+
+        # MMA - after its function call runs, the proxy reports back and the MMA ends the chat
+        if last.get("role") == "function":
+            return "manager", {"role": "assistant", "content": "TERMINATE"}
+
+        if "Conversation Sections to Summarize" in content:
+            sections = re.findall(r"Section (\d+) \(replace 'User' with (.+?)\):\n(.*?)(?=\n\nSection \d+ \(|\n\n Please make)", content, re.S)
+            results = []
+            for number, who, transcript in sections:
+                memories = [f"{who}'s {relation} {name} loves {interest}" for relation, name, interest in STATEMENT.findall(transcript)]
+                results.append({"section": int(number), "memories": memories or [f"{who} made small talk"]})
+            return "summarize_batch", function_call("append_to_short_term_memory_batch", {"sections": results})
+        
+        if "Conversation Section to Summarize" in content:
+            who = re.search(r"replace 'User' with (.+?), and", content).group(1)
+            memories = [f"{who}'s {relation} {name} loves {interest}" for relation, name, interest in STATEMENT.findall(content)]
+            return "summarize", function_call("append_to_short_term_memory", {"memories": memories or [f"{who} made small talk"]})
+
+        if "New memory or memories to incorporate" in content:
+            section = re.search(r"Long Term Memory Section:\n(.*?)\n\nNew memory or memories to incorporate:\n(.*?) \n\n", content, re.S)
+            old = ast.literal_eval(section.group(1))
+            new = [m for m in section.group(2).split("|") if m.strip()]
+            # Merge without duplicates, like a perfectly condensing MMA
+            return "consolidate", function_call("rewrite_memory", {"memories": "|".join(dict.fromkeys(old + new))})
+
+        if "What do I know about" in content:
+            relevant = re.search(r"Relevant Long Term Memory:\n(.*?)\n\nWhat do I know about", content, re.S).group(1)
+            return "lookup", {"role": "assistant", "content": f"From memory: {relevant[:200]} TERMINATE"}
+
+        return "manager", {"role": "assistant", "content": "TERMINATE"}
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": dict(self.calls),
+                "reply_path_calls": self.reply_path_calls,
+                "prompt_tokens": dict(self.prompt_tokens),
+                "completion_tokens": dict(self.completion_tokens),
+            }
+
+
+def function_call(name, arguments):
+    return {"role": "assistant", "content": None, "function_call": {"name": name, "arguments": json.dumps(arguments)}}
@@ -0,0 +1,199 @@
+# End to end benchmark of a MemoryEnabledAgent holding a long synthetic conversation against the fake LLM.
+#
+#   python -m benchmarks.memory_agent --turns 1000 --output results.json
+#   python -m benchmarks.memory_agent --turns 1000 --configs default,small_stm --baseline results.json
+#   python -m benchmarks.memory_agent --turns 500 --set DEFAULT_MAX_CONTEXT_TOKENS=4096
+#   python -m benchmarks.memory_agent --turns 500 --restate-every 3 --set DEFAULT_STM_DEDUP_SIMILARITY=None
+#   python -m benchmarks.memory_agent --turns 500 --unique-names --set DEFAULT_LTM_PREFETCH_TOKENS=0
+#
+# Every settings preset runs in a fresh process (so peak RSS is per preset) in a scratch directory (so memories start empty).
+# Results are JSON: per-turn latency percentiles, LLM calls and tokens per turn, file I/O, peak RSS, and the spans and counters
+# recorded by the agents instrumentation hooks (store transactions, memory bytes read/written, time in trim/summarize/lookup...).
+import argparse
+import ast
+import contextlib
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from benchmarks import REPOSITORY_ROOT, common
+from benchmarks.conversation import synthetic_conversation
+from benchmarks.fake_llm import FakeLLM
+
+# DEFAULT_* overrides per named preset
+PRESETS = {
+    "default": {},
+    "tight_context": {"DEFAULT_MAX_CONTEXT_TOKENS": 1024, "DEFAULT_COMPRESSION_RATIO_CHAT": 0.5},
+    "small_stm": {"DEFAULT_SHORT_TERM_MEMORY_LIMIT": 5, "DEFAULT_COMPRESSION_RATIO_STM": 0.6},
+    "large_stm": {"DEFAULT_SHORT_TERM_MEMORY_LIMIT": 20},
+    "synchronous": {"DEFAULT_BACKGROUND_MEMORY": False},
+    "adaptive": {"DEFAULT_ADAPTIVE_COMPRESSION": True},
+}
+
+
+# Swallows the agents' console output, which would otherwise dominate the measured write syscalls
+class DiscardOutput(io.TextIOBase):
+    def write(self, text):
+        return len(text)
+
+
+def run_config(name, overrides, turns, seed, llm_latency_ms, verbose = False, restate_every = 0, unique_names = False):
+    if verbose:
+        return run_conversation(name, overrides, turns, seed, llm_latency_ms, restate_every, unique_names)
+    with contextlib.redirect_stdout(DiscardOutput()):
+        return run_conversation(name, overrides, turns, seed, llm_latency_ms, restate_every, unique_names)
+
+
+def run_conversation(name, overrides, turns, seed, llm_latency_ms, restate_every = 0, unique_names = False):
+    import autogen
+    from EnhancedAgents import MemoryEnabledAgent, RecordingInstrumentation
+
+    workdir = tempfile.mkdtemp(prefix = "mea_benchmark_")
+    os.chdir(workdir)
+
+    llm = FakeLLM(latency_ms = llm_latency_ms)
+    llm.install()
+
+    # Spans and counters from the agents own instrumentation hooks
+    agent_class = type(f"Benchmark_{name}", (MemoryEnabledAgent,), dict(overrides))
+    instrumentation = RecordingInstrumentation(verbosity = agent_class.DEFAULT_DEBUG_VERBOSITY)
+    mea = agent_class("Cortana", {"config_list": [{"model": "gpt-3.5-turbo", "api_key": "offline"}]}, instrumentation = instrumentation)
+    user = autogen.UserProxyAgent(
+        "Andy",
+        human_input_mode = "NEVER",
+        max_consecutive_auto_reply = 0,
+        code_execution_config = False,
+        function_map = mea.get_function_map(),
+    )
+    user.initiate_chat(mea, message = "(User:Andy Connected)", silent = True)
+    instrumentation.reset()
+
+    latencies = []
+    questions = lookup_calls = 0
+    io_before = common.process_io()
+    start = time.perf_counter()
+    for message in synthetic_conversation(turns, seed, restate_every = restate_every, unique_names = unique_names):
+        turn_start = time.perf_counter()
+        user.send(message, mea, request_reply = True, silent = True)
+        questions += message.startswith("Do you remember")
+        # The user proxy does not auto reply, so run the MEA's memory lookups here - they are part of the turn
+        reply = user.last_message(mea)
+        if reply.get("function_call"):
+            lookup_calls += 1
+            _, result = user.generate_function_call_reply([reply])
+            user.send(result, mea, request_reply = True, silent = True)
+        latencies.append((time.perf_counter() - turn_start)*1000)
+    conversation_seconds = time.perf_counter() - start
+
+    # Background memory work still queued counts toward cost, not toward turn latency
+    drain_start = time.perf_counter()
+    mea.flush_memories()
+    drain_seconds = time.perf_counter() - drain_start
+    io_after = common.process_io()
+
+    partition = mea.memory_partition(user.name)
+    llm_stats = llm.stats()
+    total_calls = sum(llm_stats["calls"].values())
+    prompt_tokens = sum(llm_stats["prompt_tokens"].values())
+    completion_tokens = sum(llm_stats["completion_tokens"].values())
+    result = {
+        "settings": common.agent_settings(agent_class),
+        "turn_latency_ms": common.percentiles(latencies),
+        "conversation_seconds": conversation_seconds,
+        "drain_seconds": drain_seconds,
+        "llm_calls": {
+            "total": total_calls,
+            "per_turn": total_calls/turns,
+            "reply_path_per_turn": llm_stats["reply_path_calls"]/turns,
+            "by_kind": llm_stats["calls"],
+        },
+        "tokens": {
+            "prompt": prompt_tokens,
+            "completion": completion_tokens,
+            "prompt_per_turn": prompt_tokens/turns,
+            "completion_per_turn": completion_tokens/turns,
+            "prompt_by_kind": llm_stats["prompt_tokens"],
+        },
+        "lookups": {
+            "questions": questions,
+            "function_calls": lookup_calls,
+            "per_question": lookup_calls/questions if questions else 0.0,
+            "prefetch_hit_rate": prefetch_hit_rate(instrumentation.snapshot()["counters"]),
+        },
+        "compression": mea.compression_controller.stats(),
+        "io": common.io_delta(io_before, io_after),
+        "instrumentation": instrumentation.snapshot(),
+        "peak_rss_mb": common.peak_rss_mb(),
+        "memories": {
+            **{tier: partition.store.count(tier) for tier in ("stm", "ltm", "consolidating")},
+            "suppressed": partition.suppressed_memories,
+        },
+        "worker_errors": mea.consolidation_worker.num_errors if mea.consolidation_worker else 0,
+    }
+
+    os.chdir(REPOSITORY_ROOT)
+    shutil.rmtree(workdir, ignore_errors = True)
+    return result
+
+
+# Share of incoming messages the MEA found related LTM entries to prefetch for
+def prefetch_hit_rate(counters):
+    attempts = counters.get("ltm_prefetch_hits", 0) + counters.get("ltm_prefetch_misses", 0)
+    return counters.get("ltm_prefetch_hits", 0)/attempts if attempts else 0.0
+
+
+def parse_settings(pairs):
+    overrides = {}
+    for pair in pairs:
+        key, value = pair.split("=", 1)
+        try:
+            overrides[key] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            overrides[key] = value
+    return overrides
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Offline MemoryEnabledAgent benchmark with a fake LLM.")
+    parser.add_argument("--turns", type = int, default = 200, help = "user messages per conversation")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--configs", default = ",".join(PRESETS), help = f"comma separated presets: {', '.join(PRESETS)}")
+    parser.add_argument("--set", action = "append", default = [], metavar = "DEFAULT_X=VALUE", help = "override a setting in every preset")
+    parser.add_argument("--llm-latency-ms", type = float, default = 0, help = "simulated time per LLM call")
+    parser.add_argument("--restate-every", type = int, default = 0, help = "tell an earlier fact again every N turns")
+    parser.add_argument("--unique-names", action = "store_true", help = "a new person in every fact, so questions need long term memory")
+    parser.add_argument("--output", help = "write JSON results here instead of stdout")
+    parser.add_argument("--baseline", help = "JSON results of an earlier run to compare against")
+    parser.add_argument("--verbose", action = "store_true", help = "show the agents' console output")
+    args = parser.parse_args(argv)
+
+    extra = parse_settings(args.set)
+    results = {
+        "benchmark": "memory_agent",
+        "turns": args.turns,
+        "seed": args.seed,
+        "llm_latency_ms": args.llm_latency_ms,
+        "restate_every": args.restate_every,
+        "unique_names": args.unique_names,
+        "environment": common.environment(),
+        "configs": {},
+    }
+
+    # A fresh process per preset - clean peak RSS, no shared worker threads or module state
+    context = multiprocessing.get_context("spawn")
+    for name in args.configs.split(","):
+        overrides = {**PRESETS[name], **extra}
+        with context.Pool(1) as pool:
+            results["configs"][name] = pool.apply(run_config, (name, overrides, args.turns, args.seed, args.llm_latency_ms, args.verbose, args.restate_every, args.unique_names))
+
+    common.write_results(results, args.output)
+    if args.baseline:
+        common.print_comparison(common.load_results(args.baseline), results)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# Fleet startup benchmark: how long it takes to construct many MemoryEnabledAgents, and how much memory each one holds -
+# idle, and after its first memory operation with its own memory manager or with managers borrowed from a shared pool.
+#
+#   python -m benchmarks.startup --agents 200 --output startup.json
+#   python -m benchmarks.startup --agents 200 --variants lazy,pooled --baseline startup.json
+#
+# Every variant runs in a fresh process in a scratch directory. Results are JSON: construction and first memory operation latency
+# percentiles per agent, total cold start time, resident memory per agent, memory managers created and files created on disk.
+import argparse
+import contextlib
+import gc
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from benchmarks import REPOSITORY_ROOT, common
+from benchmarks.fake_llm import FakeLLM
+from benchmarks.memory_agent import DiscardOutput
+
+# lazy: construct only. eager: also build each agents memory manager and memory folder up front, as construction used to.
+# private: construct, then one memory lookup per agent with its own manager. pooled: the same lookups through a shared MemoryManagerPool.
+VARIANTS = ["lazy", "eager", "private", "pooled"]
+
+
+def run_variant(variant, agents, pool_size, verbose = False):
+    if verbose:
+        return run_fleet(variant, agents, pool_size)
+    with contextlib.redirect_stdout(DiscardOutput()):
+        return run_fleet(variant, agents, pool_size)
+
+
+def run_fleet(variant, agents, pool_size):
+    import autogen
+    from EnhancedAgents import MemoryEnabledAgent, MemoryManagerPool
+    
+    workdir = tempfile.mkdtemp(prefix = "mea_startup_")
+    os.chdir(workdir)
+    
+    llm = FakeLLM()
+    llm.install()
+    
+    gpt_config = {"config_list": [{"model": "gpt-3.5-turbo", "api_key": "offline"}]}
+    pool = MemoryManagerPool(size = pool_size) if variant == "pooled" else None
+    user = autogen.UserProxyAgent("Andy", human_input_mode = "NEVER", code_execution_config = False)
+    
+    gc.collect()
+    rss_before = common.current_rss_mb()
+    fleet = []
+    construct_ms = []
+    start = time.perf_counter()
+    for number in range(agents):
+        agent_start = time.perf_counter()
+        agent = MemoryEnabledAgent(f"Agent_{number}", gpt_config, memory_manager_pool = pool)
+        if variant == "eager":
+            agent.memory_manager
+            os.makedirs(agent.memories_path, exist_ok = True)
+        fleet.append(agent)
+        construct_ms.append((time.perf_counter() - agent_start)*1000)
+    cold_start_seconds = time.perf_counter() - start
+    gc.collect()
+    rss_constructed = common.current_rss_mb()
+    
+    # First memory operation per agent - opens the senders memory and, without a pool, creates the agents memory manager
+    first_memory_op_ms = []
+    if variant in ("private", "pooled"):
+        for agent in fleet:
+            agent.sender_agent = user
+            op_start = time.perf_counter()
+            agent.lookup_from_long_term_memory("what Alice loves")
+            first_memory_op_ms.append((time.perf_counter() - op_start)*1000)
+        gc.collect()
+    rss_after = common.current_rss_mb()
+    
+    if pool is not None:
+        managers = pool.stats()["managers"]
+    else:
+        managers = sum(agent._memory_manager is not None for agent in fleet)
+    files_created = sum(len(dirs) + len(files) for _, dirs, files in os.walk(workdir))
+    
+    result = {
+        "agents": agents,
+        "construct_ms": common.percentiles(construct_ms),
+        "cold_start_seconds": cold_start_seconds,
+        "first_memory_op_ms": common.percentiles(first_memory_op_ms),
+        "rss_mb": {"before": rss_before, "constructed": rss_constructed, "after": rss_after},
+        "rss_per_agent_kb": {
+            "constructed": (rss_constructed - rss_before)*1024/agents,
+            "after_memory_op": (rss_after - rss_before)*1024/agents,
+        },
+        "memory_managers": managers,
+        "files_created": files_created,
+        "llm_calls": sum(llm.stats()["calls"].values()),
+    }
+    
+    for agent in fleet:
+        agent.flush_memories()
+    os.chdir(REPOSITORY_ROOT)
+    shutil.rmtree(workdir, ignore_errors = True)
+    return result
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Offline MemoryEnabledAgent fleet startup benchmark with a fake LLM.")
+    parser.add_argument("--agents", type = int, default = 200, help = "agents to construct")
+    parser.add_argument("--variants", default = ",".join(VARIANTS), help = f"comma separated variants: {', '.join(VARIANTS)}")
+    parser.add_argument("--pool-size", type = int, default = 4, help = "managers per LLM config in the pooled variant")
+    parser.add_argument("--output", help = "write JSON results here instead of stdout")
+    parser.add_argument("--baseline", help = "JSON results of an earlier run to compare against")
+    parser.add_argument("--verbose", action = "store_true", help = "show the agents' console output")
+    args = parser.parse_args(argv)
+    
+    results = {
+        "benchmark": "startup",
+        "agents": args.agents,
+        "pool_size": args.pool_size,
+        "environment": common.environment(),
+        "configs": {},
+    }
+    
+    # A fresh process per variant - resident memory is measured from a clean interpreter
+    context = multiprocessing.get_context("spawn")
+    for variant in args.variants.split(","):
+        with context.Pool(1) as pool:
+            results["configs"][variant] = pool.apply(run_variant, (variant, args.agents, args.pool_size, args.verbose))
+    
+    common.write_results(results, args.output)
+    if args.baseline:
+        common.print_comparison(common.load_results(args.baseline), results)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# Token cost of the chat sections sent to the memory manager for summarizing: the repr of the message dicts, as the prompt was
+# built before, against the compact transcript from render_transcript.
+#
+#   python -m benchmarks.transcript --turns 1000 --output transcript.json
+#   python -m benchmarks.transcript --turns 1000 --tool-output-tokens 2000 --baseline transcript.json
+#
+# Sections are cut from a synthetic conversation the way the MEA trims its chat: user messages, assistant replies and function
+# results (short lookup answers, and in the 'tool_output' config a large tool result every --tool-output-every messages).
+import argparse
+import json
+import random
+import statistics
+import time
+
+from benchmarks import common
+from benchmarks.conversation import synthetic_conversation
+
+# Large function results per config - every N messages, or never
+CONFIGS = {"chat": 0, "tool_output": 10}
+
+
+def chat_sections(turns, seed, section_messages, tool_output_every, tool_output_tokens):
+    rng = random.Random(seed)
+    messages = []
+    for message in synthetic_conversation(turns, seed):
+        messages.append({"content": message, "role": "user"})
+        if message.startswith("Do you remember"):
+            messages.append({"content": "From memory: Andy's sister Alice loves hiking|Andy's friend Bruno loves chess", "role": "function", "name": "lookup_from_long_term_memory"})
+        messages.append({"content": "Noted, thanks for telling me.\nIs there anything else you would like me to remember?", "role": "assistant"})
+        if tool_output_every and len(messages) % tool_output_every == 0:
+            # Rows of a JSON result, about 12 tokens each
+            rows = [{"id": rng.randrange(10**6), "status": rng.choice(["ok", "failed", "pending"]), "value": round(rng.random(), 4)} for _ in range(max(1, tool_output_tokens//12))]
+            messages.append({"content": json.dumps(rows, indent = 2), "role": "function", "name": "run_query"})
+    return [messages[i:i + section_messages] for i in range(0, len(messages), section_messages)]
+
+
+def run_config(name, tool_output_every, args):
+    from EnhancedAgents import MemoryEnabledAgent, count_tokens, render_transcript
+    
+    max_function_tokens = MemoryEnabledAgent.DEFAULT_SUMMARY_FUNCTION_OUTPUT_TOKENS if args.max_function_tokens is None else args.max_function_tokens
+    sections = chat_sections(args.turns, args.seed, args.section_messages, tool_output_every, args.tool_output_tokens)
+    repr_tokens = []
+    transcript_tokens = []
+    render_us = []
+    digested = 0
+    for section in sections:
+        repr_tokens.append(count_tokens(f"{section}"))
+        start = time.perf_counter()
+        transcript, outputs = render_transcript(section, max_function_tokens)
+        render_us.append((time.perf_counter() - start)*1e6)
+        transcript_tokens.append(count_tokens(transcript))
+        digested += len(outputs)
+    
+    return {
+        "sections": len(sections),
+        "repr_tokens": sum(repr_tokens),
+        "transcript_tokens": sum(transcript_tokens),
+        "reduction": 1 - sum(transcript_tokens)/sum(repr_tokens),
+        "per_section": {
+            "repr_tokens": statistics.mean(repr_tokens),
+            "transcript_tokens": statistics.mean(transcript_tokens),
+            "reduction": common.percentiles([1 - t/r for r, t in zip(repr_tokens, transcript_tokens)]),
+        },
+        "render_us": common.percentiles(render_us),
+        "function_outputs_digested": digested,
+        "max_function_tokens": max_function_tokens,
+    }
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Summarize prompt tokens: message repr against compact transcript.")
+    parser.add_argument("--turns", type = int, default = 1000, help = "user messages in the conversation")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--configs", default = ",".join(CONFIGS), help = f"comma separated configs: {', '.join(CONFIGS)}")
+    parser.add_argument("--section-messages", type = int, default = 8, help = "messages per trimmed section")
+    parser.add_argument("--tool-output-every", type = int, help = "messages between large function results in the tool_output config")
+    parser.add_argument("--tool-output-tokens", type = int, default = 1000, help = "size of a large function result")
+    parser.add_argument("--max-function-tokens", type = int, help = "function result cut off, defaults to DEFAULT_SUMMARY_FUNCTION_OUTPUT_TOKENS")
+    parser.add_argument("--output", help = "write JSON results here instead of stdout")
+    parser.add_argument("--baseline", help = "JSON results of an earlier run to compare against")
+    args = parser.parse_args(argv)
+    
+    results = {
+        "benchmark": "transcript",
+        "turns": args.turns,
+        "seed": args.seed,
+        "section_messages": args.section_messages,
+        "tool_output_tokens": args.tool_output_tokens,
+        "environment": common.environment(),
+        "configs": {},
+    }
+    for name in args.configs.split(","):
+        tool_output_every = CONFIGS[name] and (args.tool_output_every or CONFIGS[name])
+        results["configs"][name] = run_config(name, tool_output_every, args)
+    
+    common.write_results(results, args.output)
+    if args.baseline:
+        common.print_comparison(common.load_results(args.baseline), results)
+    return results
+
+
+if __name__ == "__main__":
+    main()